@@ -0,0 +1,405 @@
+"""Offline benchmark for migrate.py.
+
+Starts a local stand-in for the GitHub REST endpoints migrate.py uses,
+serving git over smart HTTP from local bare repos, then migrates
+synthetic organizations of the requested sizes and reports end-to-end
+and per-phase throughput from migrate.py's run report.
+
+    python benchmark.py --sizes 10 1000 10000 --latency 50
+    python benchmark.py --sizes 1000 --output results.json
+    python benchmark.py --sizes 1000 --baseline results.json
+"""
+import json
+import argparse
+import logging
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, urlencode
+
+logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s',level=logging.INFO, datefmt='%d/%m/%Y %I:%M:%S')
+logger = logging.getLogger(__name__)
+
+source_org = "bench-source"
+target_org = "bench-target"
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Benchmark migrate.py against a local fake GitHub")
+    parser.add_argument("--sizes", help="Number of repos in each synthetic organization", required=False, type=int, nargs="+", default=[10, 1000, 10000])
+    parser.add_argument("--latency", help="Latency added to every API response, in milliseconds", required=False, type=float, default=0)
+    parser.add_argument("--max-per-page", help="Largest page size the fake API honours", required=False, type=int, default=100)
+    parser.add_argument("--members", help="Members per synthetic organization, defaults to half the repo count", required=False, type=int)
+    parser.add_argument("--teams", help="Teams per synthetic organization, defaults to a tenth of the repo count", required=False, type=int)
+    parser.add_argument("--prs-per-repo", help="Pull requests per repo, only used with --migrate-prs in the migrate args", required=False, type=int, default=2)
+    parser.add_argument("--commits", help="Commits in the template repo every synthetic repo is served from", required=False, type=int, default=20)
+    parser.add_argument("--output", help="Write the results as JSON to this file", required=False)
+    parser.add_argument("--baseline", help="Compare against results previously written with --output", required=False)
+    parser.add_argument("--tolerance", help="Allowed slowdown against --baseline before a size is reported as a regression, in percent", required=False, type=float, default=10)
+    parser.add_argument("migrate_args", help="Extra arguments passed to migrate.py after --, e.g. -- --jobs 8 --migrate-prs", nargs=argparse.REMAINDER)
+    return parser.parse_args()
+
+class FakeGitHub():
+    """In-memory state of the fake GitHub instance shared by all request handlers."""
+    def __init__(self, root, template, repos, members, teams, prs_per_repo, latency, max_per_page):
+        self.root = root
+        self.template = template
+        self.latency = latency
+        self.max_per_page = max_per_page
+        self.prs_per_repo = prs_per_repo
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.orgs = {
+            source_org: {
+                "repos": {"repo{}".format(i): {"name": "repo{}".format(i), "private": False, "description": "Synthetic repo {}".format(i), "size": 100} for i in range(repos)},
+                "members": {"user{}".format(i): "admin" if i % 20 == 0 else "member" for i in range(members)},
+                "teams": [{"id": i, "name": "team{}".format(i), "repos": ["repo{}".format(j) for j in range(i, repos, max(teams, 1))][:50],
+                           "members": ["user{}".format(j) for j in range(i, members, max(teams, 1))][:10]} for i in range(teams)],
+            }
+        }
+        self.created = {}
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def github(self):
+        return self.server.github
+
+    def base_url(self):
+        return "http://{}:{}".format(*self.server.server_address[:2])
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-RateLimit-Remaining", "5000")
+        self.send_header("X-RateLimit-Reset", str(int(time.time()) + 3600))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_page(self, items):
+        url = urlparse(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        per_page = min(int(query.get("per_page", 30)), self.github.max_per_page)
+        page = int(query.get("page", 1))
+        last = max(1, (len(items) + per_page - 1) // per_page)
+        page_url = lambda number: "{}{}?{}".format(self.base_url(), url.path, urlencode(dict(query, per_page=per_page, page=number)))
+        links = []
+        if page < last:
+            links.append('<{}>; rel="next"'.format(page_url(page + 1)))
+            links.append('<{}>; rel="last"'.format(page_url(last)))
+        self.send_json(200, items[(page - 1) * per_page:page * per_page], {"Link": ", ".join(links)} if links else None)
+
+    def serve_git(self, path):
+        org, rest = path.lstrip("/").split("/", 1)
+        # Every source repo is served from the same template repo
+        path_info = "/" + os.path.relpath(self.github.template, self.github.root) + "/" + rest.split(".git/", 1)[1] if org == source_org else path
+        body = self.read_body()
+        env = dict(os.environ, GIT_PROJECT_ROOT=self.github.root, GIT_HTTP_EXPORT_ALL="1", PATH_INFO=path_info, REMOTE_USER="bench", REMOTE_ADDR="127.0.0.1",
+                   QUERY_STRING=urlparse(self.path).query, REQUEST_METHOD=self.command, CONTENT_TYPE=self.headers.get("Content-Type", ""), CONTENT_LENGTH=str(len(body)))
+        if self.headers.get("Content-Encoding"):
+            env["HTTP_CONTENT_ENCODING"] = self.headers["Content-Encoding"]
+        output = subprocess.run(["git", "-c", "http.receivepack=true", "http-backend"], input=body, env=env, stdout=subprocess.PIPE).stdout
+        header, _, content = output.partition(b"\r\n\r\n")
+        status = 200
+        headers = []
+        for line in header.decode().split("\r\n"):
+            name, _, value = line.partition(": ")
+            if name.lower() == "status":
+                status = int(value.split()[0])
+            elif name:
+                headers.append((name, value))
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def handle_request(self):
+        path = urlparse(self.path).path
+        if ".git/" in path:
+            return self.serve_git(path)
+        with self.github.lock:
+            self.github.calls += 1
+        if self.github.latency:
+            time.sleep(self.github.latency / 1000.0)
+        query = {name: values[0] for name, values in parse_qs(urlparse(self.path).query).items()}
+        path = path[len("/api/v3"):] if path.startswith("/api/v3") else path
+        for pattern, method in self.routes:
+            match = re.fullmatch(pattern, path)
+            if match:
+                return method(self, query, *match.groups())
+        self.read_body()
+        self.send_json(404, {"message": "Not Found"})
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = handle_request
+
+    def org(self, name):
+        return self.github.orgs.get(name)
+
+    def org_repos(self, query, org_name):
+        org = self.org(org_name)
+        if org is None:
+            self.read_body()
+            return self.send_json(404, {"message": "Not Found"})
+        if self.command == "GET":
+            return self.send_page(list(org["repos"].values()))
+        repo = json.loads(self.read_body())
+        if repo["name"] in org["repos"]:
+            return self.send_json(422, {"errors": [{"message": "name already exists on this account"}]})
+        repo["size"] = 0
+        org["repos"][repo["name"]] = repo
+        subprocess.check_call(["git", "init", "--quiet", "--bare", os.path.join(self.github.root, org_name, repo["name"] + ".git")])
+        self.send_json(201, repo)
+
+    def repo(self, query, org_name, repo_name):
+        repo = self.org(org_name)["repos"].get(repo_name)
+        self.send_json(200 if repo else 404, repo or {"message": "Not Found"})
+
+    def members(self, query, org_name):
+        role = query.get("role", "all")
+        org = self.org(org_name)
+        if org is None:
+            return self.send_json(404, {"message": "Not Found"})
+        members = org["members"]
+        self.send_page([{"login": login} for login, member_role in sorted(members.items()) if role in ["all", member_role]])
+
+    def invitations(self, query, org_name):
+        self.send_page([])
+
+    def membership(self, query, org_name, login):
+        role = json.loads(self.read_body())["role"]
+        self.org(org_name)["members"][login] = role
+        self.send_json(200, {"state": "active", "role": role})
+
+    def teams(self, query, org_name):
+        org = self.org(org_name)
+        if self.command == "POST":
+            team = json.loads(self.read_body())
+            org["teams"].append(dict(team, id=len(org["teams"])))
+            return self.send_json(201, team)
+        self.send_page([{"id": team["id"], "name": team["name"], "slug": team["name"], "description": "", "privacy": "closed",
+                         "repositories_url": "{}/api/v3/orgs/{}/team/{}/repos".format(self.base_url(), org_name, team["id"]),
+                         "members_url": "{}/api/v3/orgs/{}/team/{}/members{{/member}}".format(self.base_url(), org_name, team["id"])} for team in org["teams"]])
+
+    def team_repos(self, query, org_name, team_id):
+        team = self.org(org_name)["teams"][int(team_id)]
+        self.send_page([{"full_name": "{}/{}".format(org_name, repo)} for repo in team["repos"]])
+
+    def team_members(self, query, org_name, team_id):
+        team = self.org(org_name)["teams"][int(team_id)]
+        members = team["members"][:1] if query.get("role") == "maintainer" else team["members"]
+        self.send_page([{"login": login} for login in members])
+
+    def pulls(self, query, org_name, repo_name):
+        if self.command == "POST":
+            self.read_body()
+            with self.github.lock:
+                self.github.created[(org_name, repo_name)] = number = self.github.created.get((org_name, repo_name), 0) + 1
+            return self.send_json(201, {"number": number})
+        base = "{}/api/v3/repos/{}/{}".format(self.base_url(), org_name, repo_name)
+        self.send_page([{"number": number, "user": {"login": "user0"}, "title": "Change {}".format(number), "body": "Synthetic pull request",
+                         "created_at": "2020-01-01T00:00:{:02d}Z".format(number % 60), "state": "open" if number % 2 else "closed",
+                         "merged_at": None if number % 4 else "2020-01-02T00:00:00Z",
+                         # Closed pull requests had their head branch deleted, as usual on GitHub
+                         "head": {"ref": "feature" if number % 2 else "deleted-{}".format(number)}, "base": {"ref": "master"}, "assignees": [{"login": "user1"}], "requested_reviewers": [],
+                         "_links": {"comments": {"href": "{}/issues/{}/comments".format(base, number)}, "review_comments": {"href": "{}/pulls/{}/comments".format(base, number)}}}
+                        for number in range(1, self.github.prs_per_repo + 1)])
+
+    def issue_comments(self, query, org_name, repo_name, number):
+        if self.command == "POST":
+            self.read_body()
+            return self.send_json(201, {})
+        self.send_page([{"user": {"login": "user1"}, "body": "Comment {}".format(i), "updated_at": "2020-01-02T00:00:{:02d}Z".format(i)} for i in range(3)])
+
+    def pull_subresource(self, query, org_name, repo_name, number, resource):
+        if self.command == "POST":
+            self.read_body()
+            return self.send_json(201, {})
+        if resource == "reviews":
+            return self.send_page([{"user": {"login": "user2"}, "body": "Looks good", "submitted_at": "2020-01-03T00:00:00Z", "state": "APPROVED"}])
+        self.send_page([{"user": {"login": "user2"}, "body": "Nit", "updated_at": "2020-01-02T12:00:00Z", "original_commit_id": "0" * 40, "original_position": 1, "path": "README.md"}])
+
+    def issue_update(self, query, org_name, repo_name, kind, number, assignees):
+        self.read_body()
+        self.send_json(201 if assignees else 200, {})
+
+    def git_dir(self, org_name, repo_name):
+        return os.path.join(self.github.root, org_name, repo_name + ".git")
+
+    def git_ref(self, query, org_name, repo_name, ref):
+        # Refs are read from the bare repos the target is pushed to
+        output = subprocess.run(["git", "-C", self.git_dir(org_name, repo_name), "rev-parse", "--verify", "--quiet", "refs/" + ref], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+        sha = output.decode().strip()
+        self.send_json(200 if sha else 404, {"ref": "refs/" + ref, "object": {"sha": sha}} if sha else {"message": "Not Found"})
+
+    def git_refs(self, query, org_name, repo_name, ref):
+        git = lambda *git_args: subprocess.call(["git", "-C", self.git_dir(org_name, repo_name)] + list(git_args), stderr=subprocess.DEVNULL)
+        if self.command == "DELETE":
+            git("update-ref", "-d", "refs/" + ref)
+            self.send_response(204)
+            return self.end_headers()
+        data = json.loads(self.read_body())
+        if self.command == "POST":
+            # update-ref with an all zero old value fails if the ref exists
+            if git("update-ref", data["ref"], data["sha"], "0" * 40) != 0:
+                return self.send_json(422, {"message": "Reference already exists"})
+            return self.send_json(201, {"ref": data["ref"], "object": {"sha": data["sha"]}})
+        git("update-ref", "refs/" + ref, data["sha"])
+        self.send_json(200, {"ref": "refs/" + ref, "object": {"sha": data["sha"]}})
+
+    def create_organization(self, query):
+        login = json.loads(self.read_body())["login"]
+        self.github.orgs.setdefault(login, {"repos": {}, "members": {}, "teams": []})
+        self.send_json(200, {"login": login})
+
+    def graphql(self, query):
+        # Answer like a GitHub Enterprise without GraphQL so --discovery graphql exercises the REST fallback
+        self.read_body()
+        self.send_json(404, {"message": "Not Found"})
+
+    routes = [
+        (r"/orgs/([^/]+)/repos", org_repos),
+        (r"/repos/([^/]+)/([^/]+)", repo),
+        (r"/orgs/([^/]+)/members", members),
+        (r"/orgs/([^/]+)/invitations", invitations),
+        (r"/orgs/([^/]+)/memberships/([^/]+)", membership),
+        (r"/orgs/([^/]+)/teams", teams),
+        (r"/orgs/([^/]+)/team/(\d+)/repos", team_repos),
+        (r"/orgs/([^/]+)/team/(\d+)/members", team_members),
+        (r"/repos/([^/]+)/([^/]+)/pulls", pulls),
+        (r"/repos/([^/]+)/([^/]+)/issues/(\d+)/comments", issue_comments),
+        (r"/repos/([^/]+)/([^/]+)/pulls/(\d+)/(comments|reviews|requested_reviewers)", pull_subresource),
+        (r"/repos/([^/]+)/([^/]+)/(issues|pulls)/(\d+)(/assignees)?", issue_update),
+        (r"/repos/([^/]+)/([^/]+)/git/ref/(.+)", git_ref),
+        (r"/repos/([^/]+)/([^/]+)/git/refs(?:/(.+))?", git_refs),
+        (r"/admin/organizations", create_organization),
+        (r"/api/graphql", graphql),
+    ]
+
+def create_template_repo(root, commits, prs):
+    work = os.path.join(root, "work")
+    git = lambda *git_args: subprocess.check_call(["git", "-C", work, "-c", "user.name=bench", "-c", "user.email=bench@example.com"] + list(git_args), stdout=subprocess.DEVNULL)
+    subprocess.check_call(["git", "init", "--quiet", work])
+    for i in range(commits):
+        with open(os.path.join(work, "file{}.txt".format(i % 10)), "a") as f:
+            f.write("change {}\n".format(i) * 100)
+        git("add", "--all")
+        git("commit", "--quiet", "-m", "Change {}".format(i))
+    git("branch", "feature")
+    git("tag", "v1.0")
+    template = os.path.join(root, "template.git")
+    subprocess.check_call(["git", "clone", "--quiet", "--bare", work, template])
+    for i in range(1, prs + 1):
+        subprocess.check_call(["git", "-C", template, "update-ref", "refs/pull/{}/head".format(i), "refs/heads/feature"])
+        subprocess.check_call(["git", "-C", template, "update-ref", "refs/pull/{}/merge".format(i), "refs/heads/master"])
+    return template
+
+def check_migration(github, log_text, migrate_args):
+    """List what went wrong in a run: logged errors and anything missing from the target org.
+
+    migrate.py logs and carries on after most failures, so a zero exit
+    code alone does not mean the organization was migrated.
+    """
+    problems = []
+    errors = [line for line in log_text.splitlines() if "[ERROR]" in line]
+    if errors:
+        problems.append("{} errors logged, first: {}".format(len(errors), errors[0]))
+    if "--dry-run" in migrate_args or "--repos" in migrate_args:
+        return problems
+    source = github.orgs[source_org]
+    target = github.orgs.get(target_org, {"repos": {}, "members": {}, "teams": []})
+    expected = [("repos", len(source["repos"]), len(target["repos"])), ("teams", len(source["teams"]), len(target["teams"])),
+                ("members", len(source["members"]), len(target["members"]))]
+    if "--migrate-prs" in migrate_args:
+        expected.append(("pull requests", len(source["repos"]) * github.prs_per_repo, sum(count for (org, repo), count in github.created.items() if org == target_org)))
+    for name, wanted, found in expected:
+        if found != wanted:
+            problems.append("{} of {} {} migrated".format(found, wanted, name))
+    return problems
+
+def run_size(size, bench_args):
+    with tempfile.TemporaryDirectory() as root:
+        template = create_template_repo(root, bench_args.commits, bench_args.prs_per_repo)
+        members = bench_args.members if bench_args.members is not None else max(size // 2, 10)
+        teams = bench_args.teams if bench_args.teams is not None else max(size // 10, 1)
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        server.daemon_threads = True
+        server.github = FakeGitHub(root, template, size, members, teams, bench_args.prs_per_repo, bench_args.latency, bench_args.max_per_page)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:{}".format(server.server_address[1])
+        report_file = os.path.join(root, "report.json")
+        migrate_args = [arg for arg in bench_args.migrate_args if arg != "--"]
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrate.py"),
+                   "--source-url", url, "--source-org", source_org, "--target-url", url, "--target-org", target_org,
+                   "--user", "bench", "--source-token", "source", "--target-token", "target", "--site-admin", "bench",
+                   "--state-file", os.path.join(root, "state.jsonl"), "--report-file", report_file] + migrate_args
+        logger.info("Migrating synthetic organization of {} repos, {} members, {} teams".format(size, members, teams))
+        start = time.time()
+        with open(os.path.join(root, "migrate.log"), "w") as log:
+            code = subprocess.call(command, cwd=root, stdout=log, stderr=subprocess.STDOUT)
+        elapsed = time.time() - start
+        server.shutdown()
+        with open(os.path.join(root, "migrate.log")) as log:
+            log_text = log.read()
+        problems = check_migration(server.github, log_text, migrate_args)
+        if code != 0 or problems:
+            logger.error("migrate.py exited with {}, {}:\n{}".format(code, "; ".join(problems) or "no other problems", log_text[-4000:]))
+        with open(report_file) as f:
+            report = json.load(f)
+        return {
+            "repos": size,
+            "exit_code": code,
+            "problems": problems,
+            "seconds": round(elapsed, 3),
+            "repos_per_minute": round(report["counters"].get("repos_synced", 0) * 60 / elapsed, 2) if elapsed else 0,
+            "api_calls": server.github.calls,
+            "phases": {name: round(phase["seconds"], 3) for name, phase in report["phases"].items()},
+            "counters": report["counters"],
+        }
+
+def print_results(results, baseline, tolerance):
+    regressions = []
+    for result in results:
+        logger.info("{repos} repos: {seconds:.1f}s end to end, {repos_per_minute} repos/min, {api_calls} API calls".format(**result))
+        for name, seconds in sorted(result["phases"].items(), key=lambda item: -item[1]):
+            logger.info("    {:<16} {:>10.2f}s".format(name, seconds))
+        previous = baseline.get(str(result["repos"]))
+        if previous:
+            change = (result["seconds"] - previous["seconds"]) * 100 / previous["seconds"] if previous["seconds"] else 0
+            logger.info("    {:+.1f}% against baseline ({:.1f}s)".format(change, previous["seconds"]))
+            if change > tolerance:
+                regressions.append(result["repos"])
+    return regressions
+
+if __name__ == '__main__':
+    bench_args = get_args()
+    baseline = {}
+    if bench_args.baseline:
+        with open(bench_args.baseline) as f:
+            baseline = {str(result["repos"]): result for result in json.load(f)}
+    results = [run_size(size, bench_args) for size in bench_args.sizes]
+    regressions = print_results(results, baseline, bench_args.tolerance)
+    if bench_args.output:
+        with open(bench_args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    failed = lambda result: result["exit_code"] or result["problems"] or result["repos"] in regressions
+    if any(failed(result) for result in results):
+        logger.error("Regressions or failures for sizes: {}".format(",".join(str(result["repos"]) for result in results if failed(result))))
+        sys.exit(1)
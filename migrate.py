@@ -1,12 +1,33 @@
 import json
+import gzip
+import re
 import argparse
+import asyncio
 import requests
 import logging
 import sys
 import tempfile
+import shutil
 import os
 import subprocess
+import fcntl
+import threading
+import time
+import random
+import atexit
+from collections import defaultdict
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from datetime import datetime
+from fnmatch import fnmatch
+from functools import partial
+from urllib.parse import urlparse, parse_qsl, urlencode
+from urllib3.exceptions import NewConnectionError
+try:
+    import yaml
+except ImportError:
+    yaml = None
 
 # Normalize received user input
 remove_trailing_slash = lambda url: url[:-1] if url.endswith("/") else url
@@ -17,39 +38,371 @@ create_headers = lambda token: {"Authorization" : "token {}".format(token)}
 
 def get_args():
     parser = argparse.ArgumentParser(description="Migrate GitHub Orginazation")
-    parser.add_argument("--source-url", help="Provide source GitHub url", required=True)
-    parser.add_argument("--source-org", help="Provide source organization name", required=True)
-    parser.add_argument("--target-url", help="provide target GitHub url", required=True)
+    parser.add_argument("command", help="migrate (default) does everything in one go, export only reads the source into --snapshot, import applies a snapshot to the target and batch migrates every organization listed in --manifest", nargs="?", choices=["migrate", "export", "import", "batch"], default="migrate")
+    parser.add_argument("--source-url", help="Provide source GitHub url", required=False)
+    parser.add_argument("--source-org", help="Provide source organization name", required=False)
+    parser.add_argument("--target-url", help="provide target GitHub url", required=False)
     parser.add_argument("--target-org", help="Provide target organization name, if not provided target_org will be created using source org", required=False)
-    parser.add_argument("--user", help="Provide user used to create source and target tokens", required=True)
-    parser.add_argument("--repos",help="Migrate only desired repos, provide repo names as space seperated values", required=False, nargs="+")
-    parser.add_argument("--source-token", help="Provide token to connect to source GitHub", required=True)
-    parser.add_argument("--target-token", help="Provide token to connect to source GitHub", required=True)
+    parser.add_argument("--user", help="Provide user used to create source and target tokens", required=False)
+    parser.add_argument("--repos",help="Migrate only desired repos, provide repo names or patterns such as api-* as space seperated values", required=False, nargs="+")
+    parser.add_argument("--source-token", help="Provide token to connect to source GitHub", required=False)
+    parser.add_argument("--target-token", help="Provide token to connect to source GitHub", required=False)
     parser.add_argument("--site-admin", help="Provide Github site administartor details to automatically create Organizations", required=False)
+    parser.add_argument("--jobs", help="Number of repos to mirror concurrently", required=False, type=int, default=1)
+    parser.add_argument("--max-retries", help="Number of times a failed or rate limited API call is retried", required=False, type=int, default=5)
+    parser.add_argument("--api-concurrency", help="Maximum number of concurrent API requests used while fetching data", required=False, type=int, default=8)
+    parser.add_argument("--state-file", help="Journal of completed work used by --resume, defaults to <source-org>-<target-org>.state.jsonl", required=False)
+    parser.add_argument("--resume", help="Skip members, teams, repos and pull requests already completed in the state file", action="store_true")
+    parser.add_argument("--incremental", help="Keep a local mirror of every repo and push only the refs that differ from the target", action="store_true")
+    parser.add_argument("--cache-dir", help="Directory of reusable bare mirrors keyed by source host/org/repo, defaults to mirror-cache with --incremental", required=False)
+    parser.add_argument("--migrate-prs", help="Migrate open and closed pull requests with their comments and reviews after each repo is pushed", action="store_true")
+    parser.add_argument("--pr-workers", help="Number of pull requests created concurrently per repo", required=False, type=int, default=4)
+    parser.add_argument("--large-repo-size", help="Repos of at least this many MB, as reported by the API, are pushed in batches of refs", required=False, type=int, default=1024)
+    parser.add_argument("--push-batch-size", help="Number of refs pushed at once for large repos", required=False, type=int, default=200)
+    parser.add_argument("--git-retries", help="Number of times a failed clone, fetch or push batch is retried", required=False, type=int, default=3)
+    parser.add_argument("--git-config", help="Extra git configuration passed to every git command as KEY=VALUE, e.g. pack.threads=8 core.compression=1 http.postBuffer=524288000", required=False, nargs="+", default=[])
+    parser.add_argument("--ref-include", help="Only push refs matching these patterns, e.g. refs/heads/* refs/tags/*", required=False, nargs="+", default=[])
+    parser.add_argument("--ref-exclude", help="Never push refs matching these patterns", required=False, nargs="+", default=["refs/pull/*/merge"])
+    parser.add_argument("--ref-rename", help="Push refs matching FROM under TO, given as FROM=TO with one * in each", required=False, nargs="+", default=["refs/pull/*=refs/pr/*"])
+    parser.add_argument("--report-file", help="JSON run report with per-phase timings and counters, defaults to <source-org>-<target-org>.report.json", required=False)
+    parser.add_argument("--prometheus-file", help="Also write the run metrics in Prometheus textfile collector format to this path", required=False)
+    parser.add_argument("--dry-run", help="Only report the planned membership changes, nothing is written to the target", action="store_true")
+    parser.add_argument("--cache-size", help="Disk budget for --cache-dir such as 500M or 20G, least recently used mirrors are evicted beyond it", required=False)
+    parser.add_argument("--snapshot", help="Snapshot file written by export and read by import, defaults to <source-org>.snapshot.jsonl.gz", required=False)
+    parser.add_argument("--discovery", help="API used to read repos, team members and pull requests from the source, graphql falls back to rest where it is unavailable", required=False, choices=["rest", "graphql"], default="rest")
+    parser.add_argument("--manifest", help="JSON or YAML file listing the organizations migrated by batch, see README", required=False)
+    parser.add_argument("--host-concurrency", help="Maximum number of concurrent API requests to one GitHub host, shared by every organization of a batch", required=False, type=int)
     args = parser.parse_args()
+    for rule in args.ref_rename:
+        if rule.count("=") != 1 or any(side.count("*") != 1 for side in rule.split("=")):
+            parser.error("--ref-rename {} must be given as FROM=TO with exactly one * in each".format(rule))
+    if args.command == "batch":
+        if args.manifest is None:
+            parser.error("--manifest is required for batch")
+        return args
+    for option in ["source_url", "source_org", "target_url", "user", "source_token"]:
+        if getattr(args, option) is None:
+            parser.error("--{} is required for {}".format(option.replace("_", "-"), args.command))
+    if args.command != "export" and args.target_token is None:
+        parser.error("--target-token is required for {}".format(args.command))
     return args
 
 args = get_args()
-source_url = normalize_url(args.source_url)
-target_url = normalize_url(args.target_url)
-source_api_url = api_url(source_url)
-target_api_url = api_url(target_url)
-source_org = args.source_org
-target_org = source_org if args.target_org is None else args.target_org
-source_token = args.source_token
-target_token = args.target_token
-source_headers = create_headers(source_token)
-target_headers = create_headers(target_token)
-user = args.user
+if args.report_file:
+    report_file = args.report_file
+elif args.command == "batch":
+    report_file = "{}.report.json".format(os.path.splitext(os.path.basename(args.manifest))[0])
+else:
+    report_file = "{}-{}.report.json".format(args.source_org, args.target_org or args.source_org)
+cache_dir = args.cache_dir if args.cache_dir or not args.incremental else "mirror-cache"
 
 logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s',level=logging.INFO, datefmt='%d/%m/%Y %I:%M:%S')
 logger = logging.getLogger(__name__)
 
+class Metrics():
+    """Thread-safe counters and per-phase timings of a migration run.
+
+    Phase seconds are summed over every thread that ran the phase, so with
+    --jobs above one they measure busy time rather than wall time.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = defaultdict(float)
+        self.phases = defaultdict(lambda: {"count": 0, "seconds": 0.0})
+        self.repos = defaultdict(lambda: defaultdict(float))
+        self.migrations = []
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    @contextmanager
+    def phase(self, name, repo=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                self.phases[name]["count"] += 1
+                self.phases[name]["seconds"] += elapsed
+                if repo is not None:
+                    self.repos[repo][name] += elapsed
+
+    def report(self):
+        with self.lock:
+            return {
+                "migrations": list(self.migrations),
+                "started": datetime.utcfromtimestamp(self.started).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "seconds": round(time.time() - self.started, 3),
+                "counters": dict(self.counters),
+                "phases": {name: dict(phase) for name, phase in self.phases.items()},
+                "repos": {repo: dict(phases) for repo, phases in self.repos.items()},
+            }
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+    def write_prometheus(self, path):
+        report = self.report()
+        lines = ["# TYPE migrate_run_seconds gauge", "migrate_run_seconds {}".format(report["seconds"])]
+        for name, value in sorted(report["counters"].items()):
+            lines += ["# TYPE migrate_{}_total counter".format(name), "migrate_{}_total {}".format(name, value)]
+        # All samples of a metric family must follow its TYPE line
+        for family, field in [("seconds", "seconds"), ("runs", "count")]:
+            lines.append("# TYPE migrate_phase_{}_total counter".format(family))
+            for name, phase in sorted(report["phases"].items()):
+                lines.append('migrate_phase_{}_total{{phase="{}"}} {}'.format(family, name, phase[field]))
+        # Write then rename so the textfile collector never reads a partial file
+        with open(path + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
+
+metrics = Metrics()
+
+class Host():
+    """Connection pool and request budget shared by every client of one GitHub instance."""
+    def __init__(self, pool_size, concurrency):
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.slots = threading.BoundedSemaphore(concurrency)
+
+class GitHubClient():
+    """Keep-alive session to a single GitHub instance with one token.
+
+    Retries 5xx and rate limited responses with jittered backoff and slows
+    down proactively when X-RateLimit-Remaining runs low. POST and PATCH
+    are only retried when the server cannot have acted on them. At most the
+    host's concurrency budget of requests are in flight at once.
+    """
+    retry_statuses = [500, 502, 503, 504, 429]
+    # Repeating anything else after the server acted would duplicate comments or pull requests
+    idempotent_methods = ["GET", "HEAD", "PUT", "DELETE"]
+
+    def __init__(self, api_url, token, host, max_retries=5, timeout=60, backoff=1, max_backoff=60, rate_limit_reserve=50):
+        self.api_url = api_url
+        self.host = host
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.rate_limit_reserve = rate_limit_reserve
+        self.remaining = None
+        self.reset = None
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.headers.update(create_headers(token))
+        self.session.mount("https://", host.adapter)
+        self.session.mount("http://", host.adapter)
+
+    def __str__(self):
+        return fetch_url_from_api(self.api_url)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        attempt = 0
+        while True:
+            self.throttle()
+            metrics.count("api_calls")
+            try:
+                with self.host.slots:
+                    response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+                if attempt >= self.max_retries or (method not in self.idempotent_methods and self.may_have_been_sent(error)):
+                    raise
+                delay = self.backoff_delay(attempt)
+                logger.warning("{} {} failed to connect, retrying in {:.1f}s".format(method, url, delay))
+            else:
+                metrics.count("api_bytes_received", len(response.content))
+                self.update_rate_limit(response)
+                if attempt >= self.max_retries or not self.should_retry(method, response):
+                    return response
+                delay = self.retry_delay(response, attempt)
+                if response.status_code in [403, 429]:
+                    metrics.count("rate_limit_wait_seconds", delay)
+                logger.warning("{} {} returned {}, retrying in {:.1f}s".format(method, url, response.status_code, delay))
+            metrics.count("api_retries")
+            time.sleep(delay)
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request("PATCH", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def should_retry(self, method, response):
+        if response.status_code == 429:
+            return True
+        if response.status_code in self.retry_statuses:
+            return method in self.idempotent_methods
+        if response.status_code == 403:
+            # Primary limit exhausted or secondary (abuse) limit hit
+            return "Retry-After" in response.headers or response.headers.get("X-RateLimit-Remaining") == "0" or "rate limit" in response.text.lower()
+        return False
+
+    def may_have_been_sent(self, error):
+        """Whether a request that failed with error could have reached the server."""
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return False
+        reason = getattr(error.args[0], "reason", None) if error.args else None
+        return not isinstance(reason, NewConnectionError)
+
+    def retry_delay(self, response, attempt):
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is not None and retry_after.isdigit():
+            return int(retry_after)
+        if response.headers.get("X-RateLimit-Remaining") == "0" and response.headers.get("X-RateLimit-Reset"):
+            return max(int(response.headers["X-RateLimit-Reset"]) - time.time(), 0) + 1
+        return self.backoff_delay(attempt)
+
+    def backoff_delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def update_rate_limit(self, response):
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        reset = response.headers.get("X-RateLimit-Reset")
+        if remaining is None or reset is None:
+            return
+        with self.lock:
+            self.remaining = int(remaining)
+            self.reset = int(reset)
+
+    def throttle(self):
+        with self.lock:
+            if self.remaining is None or self.remaining > self.rate_limit_reserve:
+                return
+            window = self.reset - time.time()
+            if window <= 0:
+                self.remaining = None
+                return
+            # Spread what is left of the budget over the rest of the window
+            delay = window if self.remaining <= 0 else window / self.remaining
+            self.remaining -= 1
+        logger.info("Rate limit low on {}, waiting {:.1f}s".format(self, delay))
+        metrics.count("rate_limit_wait_seconds", delay)
+        time.sleep(delay)
+
+class Journal():
+    """Append-only JSON lines record of completed units of work.
+
+    Each line holds a kind (member, team, repo or pr), a key and details
+    such as pushed ref SHAs or the new PR number. With resume the existing
+    entries are loaded so finished units can be skipped, otherwise the file
+    is started afresh. A read only journal never touches the file.
+    """
+    def __init__(self, path, resume=False, read_only=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Last line may be torn if the previous run was killed mid-write
+                        continue
+                    self.entries[(entry["kind"], entry["key"])] = entry
+            logger.info("Resuming from {}: {} completed units found".format(path, len(self.entries)))
+            if not read_only:
+                # Cut off a torn last line, or the next entry would be appended to it and lost
+                with open(path, "rb+") as f:
+                    f.truncate(f.read().rfind(b"\n") + 1)
+        self.file = None if read_only else open(path, "a" if resume else "w")
+
+    def get(self, kind, key):
+        return self.entries.get((kind, key))
+
+    def is_done(self, kind, key):
+        return (kind, key) in self.entries
+
+    def record(self, kind, key, **details):
+        entry = dict(kind=kind, key=key, time=datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"), **details)
+        with self.lock:
+            self.entries[(kind, key)] = entry
+            if self.file:
+                self.file.write(json.dumps(entry) + "\n")
+                self.file.flush()
+
+pool_size = max(10, args.jobs * 2, args.api_concurrency)
+hosts = {}
+clients = {}
+clients_lock = threading.Lock()
+
+def set_host_concurrency(host, concurrency):
+    with clients_lock:
+        hosts[host] = Host(max(pool_size, concurrency), concurrency)
+
+def get_client(api_url, token):
+    """Return the client for api_url and token, creating it on first use.
+
+    Clients of one host share its connection pool and request budget,
+    clients with the same token also share rate limit state.
+    """
+    with clients_lock:
+        host = urlparse(api_url).netloc
+        if host not in hosts:
+            concurrency = args.host_concurrency or pool_size
+            hosts[host] = Host(max(pool_size, concurrency), concurrency)
+        if (api_url, token) not in clients:
+            clients[(api_url, token)] = GitHubClient(api_url, token, hosts[host], max_retries=args.max_retries)
+        return clients[(api_url, token)]
+
+default_state_file = lambda source_org, target_org: "{}-{}.state.jsonl".format(source_org, target_org)
+
+# Repo names or patterns such as api-*
+has_wildcard = lambda pattern: any(char in pattern for char in "*?[")
+
+class Migration():
+    """Settings, API clients and journal of one source organization to target organization migration."""
+    def __init__(self, source_url, source_org, target_url, target_org, user, source_token, target_token, repos=None, exclude_repos=None, site_admin=None, state_file=None, snapshot_file=None, discovery="rest"):
+        self.source_url = normalize_url(source_url)
+        self.target_url = normalize_url(target_url)
+        self.source_api_url = api_url(self.source_url)
+        self.target_api_url = api_url(self.target_url)
+        self.graphql_url = "{}/api/graphql".format(self.source_url)
+        self.source_org = source_org
+        self.target_org = source_org if target_org is None else target_org
+        self.user = user
+        self.source_token = source_token
+        self.target_token = target_token
+        self.repos = repos
+        self.exclude_repos = exclude_repos or []
+        self.site_admin = site_admin
+        self.snapshot_file = snapshot_file if snapshot_file else "{}.snapshot.jsonl.gz".format(self.source_org)
+        self.use_graphql = discovery == "graphql"
+        self.source_client = get_client(self.source_api_url, source_token)
+        self.target_client = get_client(self.target_api_url, target_token)
+        self.journal = Journal(state_file if state_file else default_state_file(self.source_org, self.target_org), args.resume, read_only=args.dry_run or args.command == "export")
+
+    def __str__(self):
+        return "{}/{} -> {}/{}".format(fetch_url_from_api(self.source_api_url), self.source_org, fetch_url_from_api(self.target_api_url), self.target_org)
+
+    def wants(self, name):
+        if self.repos and not any(fnmatch(name, pattern) for pattern in self.repos):
+            return False
+        return not any(fnmatch(name, pattern) for pattern in self.exclude_repos)
+
 class Repo():
-    def __init__(self, name, private, description=None):
+    def __init__(self, name, private, description=None, size=0, pull_requests=None):
         self.name = name
         self.private = private
         self.description = description
+        # Size in KB as reported by the API
+        self.size = size
+        # Only known when discovered through GraphQL
+        self.pull_requests = pull_requests
     
     def __str__(self):
         return self.name
@@ -74,10 +427,11 @@ class User():
         self.id = id
 
 class pull_request():
-    def __init__(self, number, user, title, body, created, head, base, assignees, reviewers, reviews, review_comments, comments):
+    def __init__(self, number, user, title, body, created, head, base, assignees, reviewers, reviews, review_comments, comments, url, state="open"):
         self.number = number
         self.title = title
-        self.body = "Originally created as #{number} by [{user}]({url}/{user}) on {created} \r\n\r\n {body}".format(number=number, user=user, created=created, body=body, url=target_url)
+        # The target cannot mark a pull request merged without merging it, so say so in the body
+        self.body = "Originally created as #{number} by [{user}]({url}/{user}) on {created}{merged} \r\n\r\n {body}".format(number=number, user=user, created=created, body=body, url=url, merged=" and merged" if state == "merged" else "")
         self.head = head
         self.base = base
         self.assignees = assignees
@@ -85,22 +439,23 @@ class pull_request():
         self.reviews = reviews
         self.review_comments = review_comments
         self.comments = comments
-
+        self.state = state
 
     def __str__(self):
         return self.title
 
 class Comment():
-    def __init__(self, user, body, created):
-        self.body = "Originally created by [{user}]({url}/{user}) on {created} \r\n\r\n {body}".format(user=user, created=created, body=body, url=target_url)
+    # url is the target GitHub the user links point to
+    def __init__(self, user, body, created, url):
+        self.body = "Originally created by [{user}]({url}/{user}) on {created} \r\n\r\n {body}".format(user=user, created=created, body=body, url=url)
         self.created = created # datetime.strptime(created, "%Y-%m-%dT%H:%M:%SZ")
 
     def __str__(self):
         return self.body
 
 class ReviewComment(Comment):
-    def __init__(self, user, body, created, commit_id, position, path):
-        super().__init__(user, body, created)
+    def __init__(self, user, body, created, commit_id, position, path, url):
+        super().__init__(user, body, created, url)
         self.commit_id = commit_id
         self.path = path
         self.position = position
@@ -109,153 +464,285 @@ class ReviewComment(Comment):
         return self.body
 
 class Review(Comment):
-    def __init__(self, user, body, created, event):
-        super().__init__(user, body, created) 
-        self.body = "Originally {event} by [{user}]({url}/{user}) on {created} \r\n\r\n {body}".format(event=event, user=user, created=created, body=body, url=target_url)
+    def __init__(self, user, body, created, event, url):
+        super().__init__(user, body, created, url)
+        self.body = "Originally {event} by [{user}]({url}/{user}) on {created} \r\n\r\n {body}".format(event=event, user=user, created=created, body=body, url=url)
 
     def __str__(self):
         return self.body 
 
-def list_org_repos(url, org, token):
-    def check_follow_pagination(res, repos_list):
+def set_page(url, page):
+    parts = urlparse(url)
+    query = dict(parse_qsl(parts.query))
+    query["page"] = page
+    return parts._replace(query=urlencode(query)).geturl()
+
+# Set in gather's worker threads, which already run --api-concurrency at a time
+gathering = threading.local()
+
+def paginate(client, url, params=None):
+    """Yield every item of a paginated list endpoint.
+
+    Pages are requested 100 items at a time. Once the first response names
+    the last page, the remaining pages are fetched concurrently and yielded
+    in order; otherwise "next" links are followed one by one. Inside gather
+    pages are always read one by one, so nesting does not multiply the
+    number of requests in flight.
+    """
+    def fetch_page(page_url):
+        response = client.get(page_url)
+        response.raise_for_status()
+        return response
+
+    response = client.get(url, params=dict(params or {}, per_page=100))
+    response.raise_for_status()
+    yield from response.json()
+    if "last" in response.links and not getattr(gathering, "active", False):
+        last_url = response.links["last"]["url"]
+        last = int(dict(parse_qsl(urlparse(last_url).query))["page"])
+        page_urls = [set_page(last_url, page) for page in range(2, last + 1)]
+        with ThreadPoolExecutor(max_workers=args.api_concurrency) as executor:
+            for page in executor.map(fetch_page, page_urls):
+                yield from page.json()
+    else:
+        while "next" in response.links:
+            response = fetch_page(response.links["next"]["url"])
+            yield from response.json()
+
+def gather(calls):
+    """Run blocking calls on an asyncio loop, at most --api-concurrency at a time, and return their results in order."""
+    def run_gathered(call):
+        gathering.active = True
         try:
-            last = res.headers["Link"].split(",")[1].split(">;")[0].split("page=")[1]
-            url = res.headers["Link"].split(",")[0].split(">;")[0][1:-1]
-            fetch_repos = lambda url: requests.request("GET", headers=source_headers, url=url)
-            for i in range(2, int(last) + 1):
-                for item in fetch_repos(url + str(i)).json():
-                    repo = Repo(item["name"], item["private"], item["description"])
-                    repos_list.append(repo)
-        except Exception:
-            pass
+            return call()
+        finally:
+            gathering.active = False
+
+    async def run_all(executor):
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(args.api_concurrency)
+        async def run(call):
+            async with semaphore:
+                return await loop.run_in_executor(executor, run_gathered, call)
+        return await asyncio.gather(*(run(call) for call in calls))
+    if not calls:
+        return []
+    with ThreadPoolExecutor(max_workers=args.api_concurrency) as executor:
+        return asyncio.run(run_all(executor))
+
+fetch_all = lambda client, url, params=None: list(paginate(client, url, params))
+
+def list_org_repos(client, org):
     try:
-        headers = {"Authorization" : "token {}".format(token)}
-        response = requests.request("GET", url="{}/orgs/{}/repos".format(url, org), headers=headers)
-        if response.status_code == 200:
-            repos_list = []
-        for item in response.json():
-            repo = Repo(item["name"], item["private"], item["description"])
-            repos_list.append(repo)
-        check_follow_pagination(response, repos_list)
-        return repos_list
+        return [Repo(item["name"], item["private"], item["description"], item["size"]) for item in paginate(client, "{}/orgs/{}/repos".format(client.api_url, org))]
     except Exception:
-        logger.warning("{} organization does not exist in target GitHub: {}".format(org, fetch_url_from_api(url)))
+        logger.warning("{} organization does not exist in target GitHub: {}".format(org, client))
 
-def fetch_source_teams():
+def fetch_source_teams(migration, strict=False):
     teams = []
     try:
-        response = requests.request("GET", headers=source_headers, url="{}/orgs/{}/teams".format(source_api_url, source_org)) 
-        for team in response.json():
-            fetch_data = lambda url: requests.request("GET", headers=source_headers, url=url).json()
-            repos = []
-            for repo in fetch_data(team["repositories_url"]):
-                repos.append(repo["full_name"].replace(source_org, target_org))
-            maintainers = []
+        source_teams = fetch_all(migration.source_client, "{}/orgs/{}/teams".format(migration.source_api_url, migration.source_org))
+        # LDAP synced teams get their members from the directory, not from us
+        synced = lambda team: "ldap_dn" in team
+        members_url = lambda team: team["members_url"].split("{")[0]
+        details = discover(migration, "teams", partial(graphql_team_details, migration), dict)
+        # Teams GraphQL could not return in full are read over REST
+        pending = [team for team in source_teams if team["slug"] not in details]
+        calls = [partial(fetch_all, migration.source_client, team["repositories_url"]) for team in pending]
+        for team in pending:
+            if not synced(team):
+                calls.append(partial(fetch_all, migration.source_client, members_url(team)))
+                calls.append(partial(fetch_all, migration.source_client, members_url(team), {"role": "maintainer"}))
+        results = iter(gather(calls))
+        team_repos = [next(results) for team in pending]
+        for team, repo_items in zip(pending, team_repos):
             members = []
+            maintainers = []
+            if not synced(team):
+                members = [mem["login"] for mem in next(results)]
+                maintainers = [mem["login"] for mem in next(results)]
+            details[team["slug"]] = ([repo["full_name"] for repo in repo_items], members, maintainers)
+        for team in source_teams:
+            (repo_names, members, maintainers) = details[team["slug"]]
+            repos = [name.replace(migration.source_org, migration.target_org) for name in repo_names]
             ldap_dn = ""
-            try:
+            if synced(team):
+                members = []
+                maintainers = []
                 if team["ldap_dn"]:
                     ldap_dn = team["ldap_dn"]
-            except Exception:
-                for mem in fetch_data(team["members_url"].split("{")[0]):
-                    if fetch_data(team["members_url"].split("/members")[0]+ "/memberships/" + mem["login"])["role"] == "maintainer":
-                        maintainers.append(mem["login"])
-                    members.append(mem["login"])
             team = Team(team["name"], team["description"], team["privacy"], repos, members, maintainers, ldap_dn)
             teams.append(team)
     except Exception:
         logger.error("Exception occurred: ", exc_info=True)
+        if strict:
+            raise
     return teams
 
-def create_teams(teams):
-    for team in teams:
-        logger.info("Creating team {} in target organization {}".format(str(team), target_org))
+def create_teams(migration, teams):
+    def create(team):
+        logger.info("Creating team {} in target organization {}".format(str(team), migration.target_org))
         try:
-            response = requests.request("POST", url="{}/orgs/{}/teams".format(target_api_url, target_org), data=json.dumps(vars(team)), headers=target_headers)
+            response = migration.target_client.post("{}/orgs/{}/teams".format(migration.target_api_url, migration.target_org), data=json.dumps(vars(team)))
             if response.status_code == 201:
+                migration.journal.record("team", team.name)
                 logger.info("Team {} created successfully".format(str(team)))
             else:
                 logger.error("Team {} creation failed".format(str(team)))
         except Exception:
             logger.error("Team {} creation failed : ".format(str(team)), exc_info=True)
 
-def fetch_org_members():
+    pending = []
+    for team in teams:
+        if migration.journal.is_done("team", team.name):
+            logger.info("Team {} already created, skipping".format(str(team)))
+        else:
+            pending.append(team)
+    gather([partial(create, team) for team in pending])
+
+def fetch_org_members(migration, strict=False):
     members = []
     admins = []
-    logger.info("Fetching member list from source organization {}".format(source_org))
-    def check_follow_pagination(mems, members):
-        try:
-            last = mems.headers["Link"].split(",")[1].split(">;")[0].split("page=")[1]
-            url = mems.headers["Link"].split(",")[0].split(">;")[0][1:-1]
-            for i in range(2, int(last) + 1):
-                for mem in fetch_members(url + str(i)).json():
-                    members.append(mem["login"])
-        except Exception:
-            pass
+    logger.info("Fetching member list from source organization {}".format(migration.source_org))
     try:
-        
-        fetch_members = lambda url: requests.request("GET", headers=source_headers, url=url)
-        initial_fetch_members = fetch_members("{}/orgs/{}/members?role=members".format(source_api_url, source_org))
-        for mem in initial_fetch_members.json():
-            members.append(mem["login"])
-        check_follow_pagination(initial_fetch_members, members)
-        initial_fetch_admins = fetch_members("{}/orgs/{}/members?role=admin".format(source_api_url, source_org))
-        for mem in initial_fetch_admins.json():
-            admins.append(mem["login"])
-        check_follow_pagination(initial_fetch_admins, admins)
+        members = [mem["login"] for mem in paginate(migration.source_client, "{}/orgs/{}/members".format(migration.source_api_url, migration.source_org), {"role": "member"})]
+        admins = [mem["login"] for mem in paginate(migration.source_client, "{}/orgs/{}/members".format(migration.source_api_url, migration.source_org), {"role": "admin"})]
         logger.info("Member list fetched successfully!!!")
     except Exception:
-        logger.error("Failed to fetch member list from source organization {}".format(source_org))
+        logger.error("Failed to fetch member list from source organization {}".format(migration.source_org))
+        if strict:
+            raise
     #admins = ['smallidi']
     return (members, admins)
 
-def fetch_pull_requests(repo):
+def build_pull_requests(migration, source_prs):
+    """Yield pull_request objects for REST pull request items, fetching their comments and reviews concurrently."""
+    calls = []
+    for pr in source_prs:
+        review_comments_url = pr["_links"]["review_comments"]["href"]
+        calls.append(partial(fetch_all, migration.source_client, review_comments_url))
+        calls.append(partial(fetch_all, migration.source_client, pr["_links"]["comments"]["href"]))
+        calls.append(partial(fetch_all, migration.source_client, "{}/reviews".format(review_comments_url.split("/comments")[0])))
+    results = iter(gather(calls))
+    for pr in source_prs:
+        reviewers = [item["login"] for item in pr["requested_reviewers"]]
+        assignees = [item["login"] for item in pr["assignees"]]
+        review_comments = [ReviewComment(item["user"]["login"], item["body"], item["updated_at"], item["original_commit_id"], item["original_position"], item["path"], migration.target_url) for item in next(results)]
+        comments = [Comment(item["user"]["login"], item["body"], item["updated_at"], migration.target_url) for item in next(results)]
+        reviews = [Review(item["user"]["login"], item["body"], item["submitted_at"], item["state"], migration.target_url) for item in next(results) if item["body"] != ""]
+        yield pull_request(pr["number"], pr["user"]["login"],pr["title"], pr["body"], pr["created_at"],pr["head"]["ref"], pr["base"]["ref"], assignees, reviewers, reviews, review_comments, comments, migration.target_url, "merged" if pr.get("merged_at") else pr["state"])
+
+def stream_pull_requests(migration, repo):
+    """Yield every open and closed pull request of repo with its comments, reviews and review comments.
+
+    Pull requests are read page by page and their details fetched
+    concurrently for --api-concurrency pull requests at a time, so only
+    that many are held in memory at once. With GraphQL discovery a page
+    holds pull requests together with their details.
+    """
+    if migration.use_graphql:
+        prs = graphql_stream_pull_requests(migration, repo)
+        try:
+            first = next(prs, None)
+        except Exception as error:
+            disable_graphql(migration, "pull requests of repo {}".format(repo), error)
+        else:
+            if first is not None:
+                yield first
+                yield from prs
+            return
+
+    batch = []
+    for pr in paginate(migration.source_client, "{}/repos/{}/{}/pulls".format(migration.source_api_url, migration.source_org, repo), {"state": "all", "direction": "asc"}):
+        batch.append(pr)
+        if len(batch) == args.api_concurrency:
+            yield from build_pull_requests(migration, batch)
+            batch = []
+    yield from build_pull_requests(migration, batch)
+
+def fetch_pull_requests(migration, repo):
     prs = []
     logger.info("Fetching pull request details from source repo: {}".format(repo))
     try:
-        response = requests.request("GET", headers=source_headers, url="{}/repos/{}/{}/pulls".format(source_api_url, source_org, repo)).json()
-        
-        for pr in response:
-            #print(pr)
-            reviewers = [item["login"] for item in pr["requested_reviewers"]]
-            assignees = [item["login"] for item in pr["assignees"]]
-            review_comments = [ReviewComment(item["user"]["login"], item["body"], item["updated_at"], item["original_commit_id"], item["original_position"], item["path"]) for item in requests.get(headers=source_headers, url=pr["_links"]["review_comments"]["href"]).json()]
-            comments = [Comment(item["user"]["login"], item["body"], item["updated_at"]) for item in requests.get(headers=source_headers, url=pr["_links"]["comments"]["href"]).json()]
-            reviews = [Review(item["user"]["login"], item["body"], item["submitted_at"], item["state"]) for item in requests.get(headers=source_headers, url="{}/reviews".format(pr["_links"]["review_comments"]["href"].split("/comments")[0])).json() if item["body"] != ""]
-            new_pr = pull_request(pr["number"], pr["user"]["login"],pr["title"], pr["body"], pr["created_at"],pr["head"]["ref"], pr["base"]["ref"], assignees, reviewers, reviews, review_comments, comments)
-            prs.append(new_pr)
+        prs = list(stream_pull_requests(migration, repo))
         logger.info("Pull requests fetched successfully from source GitHub")
     except Exception:
         logger.error("Failed to fetch pull requests from source repo: {}".format(repo), exc_info=True)
     return prs
 
-def create_pull_requests(repo, prs):
+def target_ref_sha(migration, repo, ref):
+    """Return the commit ref points to in the target repo, or None if it does not exist."""
+    response = migration.target_client.get("{}/repos/{}/{}/git/ref/{}".format(migration.target_api_url, migration.target_org, repo, ref[len("refs/"):]))
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.json()["object"]["sha"]
+
+def pull_request_head(migration, repo, pr):
+    """Return the target branch to create pr from and whether it was made for the migration.
+
+    The head branch of a closed or merged pull request is usually deleted.
+    Those are created from a branch pointing at the head pushed under
+    --ref-rename instead, or None is returned when that was not pushed.
+    """
+    if pr.state == "open" or target_ref_sha(migration, repo, "refs/heads/" + pr.head):
+        return pr.head, False
+    pushed = ref_rules.target_name("refs/pull/{}/head".format(pr.number))
+    sha = target_ref_sha(migration, repo, pushed) if pushed else None
+    if sha is None:
+        return None, False
+    branch = "migrated-pr-{}".format(pr.number)
+    refs_url = "{}/repos/{}/{}/git/refs".format(migration.target_api_url, migration.target_org, repo)
+    response = migration.target_client.post(refs_url, json={"ref": "refs/heads/" + branch, "sha": sha})
+    # Left behind by an interrupted run
+    if response.status_code == 422:
+        response = migration.target_client.patch("{}/heads/{}".format(refs_url, branch), json={"sha": sha, "force": True})
+    if response.status_code not in [200, 201]:
+        raise Exception
+    return branch, True
+
+def create_pull_requests(migration, repo, prs):
     #create_base_branches()
     def check_status(res):
         if res.status_code != 201:
             raise Exception
     for pr in prs:
+        pr_key = "{}#{}".format(repo, pr.number)
+        if migration.journal.is_done("pr", pr_key):
+            logger.info("Pull request {} already migrated as {}, skipping".format(pr.number, migration.journal.get("pr", pr_key)["number"]))
+            continue
         logger.info("Migrating pull request {} to target github".format(pr.number))
+        head, temporary = None, False
         try:
-            data={"title" : pr.title, "body" : pr.body, "head": pr.head, "base": pr.base}
-            response = requests.request("POST", headers=target_headers, url="{}/repos/{}/{}/pulls".format(target_api_url, target_org, repo), json=data)
+            head, temporary = pull_request_head(migration, repo, pr)
+            if head is None:
+                logger.warning("Skipping {} pull request {} of repo {}: head branch {} is deleted and its head ref was not pushed".format(pr.state, pr.number, repo, pr.head))
+                metrics.count("pull_requests_skipped")
+                continue
+            data={"title" : pr.title, "body" : pr.body, "head": head, "base": pr.base}
+            response = migration.target_client.post("{}/repos/{}/{}/pulls".format(migration.target_api_url, migration.target_org, repo), json=data)
+            # GitHub refuses a pull request whose head is already part of its base, as for most merged ones
+            if response.status_code == 422 and pr.state != "open":
+                logger.warning("Skipping {} pull request {} of repo {}: target refused it with {}".format(pr.state, pr.number, repo, response.text))
+                metrics.count("pull_requests_skipped")
+                continue
             check_status(response)
             pr_number = response.json()["number"]
             # Adding reviewers
             logger.info("Adding reviewers to new pull request {}".format(pr_number))
-            res = requests.request("POST", headers=target_headers, json={"reviewers": pr.reviewers}, url="{}/repos/{}/{}/pulls/{}/requested_reviewers".format(target_api_url, target_org, repo, pr_number))
+            res = migration.target_client.post("{}/repos/{}/{}/pulls/{}/requested_reviewers".format(migration.target_api_url, migration.target_org, repo, pr_number), json={"reviewers": pr.reviewers})
             check_status(res)
             logger.info("Reviewers added to new pull request {} successfully".format(pr_number))
             # Adding assignees
             logger.info("Adding assignees to new pull request {}".format(pr_number))
-            r = requests.request("POST", headers=target_headers, json={"assignees": pr.assignees}, url="{}/repos/{}/{}/issues/{}/assignees".format(target_api_url, target_org, repo, pr_number))
+            r = migration.target_client.post("{}/repos/{}/{}/issues/{}/assignees".format(migration.target_api_url, migration.target_org, repo, pr_number), json={"assignees": pr.assignees})
             check_status(r)
             logger.info("Assignees added to new pull request {} successfully".format(pr_number))
             all_comments = pr.comments + pr.reviews + pr.review_comments
             all_comments.sort(key= lambda x: x.created)
-            add_comment = lambda comment: requests.post(headers=target_headers, data=json.dumps(vars(comment)),url="{}/repos/{}/{}/issues/{}/comments".format(target_api_url, target_org, repo, pr_number))
-            add_review_comment = lambda review_comment: requests.post(headers=target_headers, data=json.dumps(vars(review_comment)),url="{}/repos/{}/{}/pulls/{}/comments".format(target_api_url, target_org, repo, pr_number))
-            # add_review = lambda review: requests.post(headers=target_headers, data=json.dumps(vars(review)),url="{}/repos/{}/{}/pulls/{}/reviews".format(target_api_url, target_org, repo, pr_number))
+            add_comment = lambda comment: migration.target_client.post("{}/repos/{}/{}/issues/{}/comments".format(migration.target_api_url, migration.target_org, repo, pr_number), data=json.dumps(vars(comment)))
+            add_review_comment = lambda review_comment: migration.target_client.post("{}/repos/{}/{}/pulls/{}/comments".format(migration.target_api_url, migration.target_org, repo, pr_number), data=json.dumps(vars(review_comment)))
+            # add_review = lambda review: migration.target_client.post("{}/repos/{}/{}/pulls/{}/reviews".format(migration.target_api_url, migration.target_org, repo, pr_number), data=json.dumps(vars(review)))
             # Adding reviews/comments
             logger.info("Adding reviews/comments to new pull request {}".format(pr_number))
             for comment in all_comments:
@@ -268,49 +755,253 @@ def create_pull_requests(repo, prs):
                 
                 check_status(com_res)
             logger.info("Reviews/Comments added to new pull request {} successfully".format(pr_number))
+            if pr.state != "open":
+                res = migration.target_client.patch("{}/repos/{}/{}/pulls/{}".format(migration.target_api_url, migration.target_org, repo, pr_number), json={"state": "closed"})
+                if res.status_code != 200:
+                    raise Exception
+            migration.journal.record("pr", pr_key, number=pr_number, state=pr.state)
             logger.info("Pull request {} migrated successfully to target GitHub".format(pr.number))
         except Exception:
             logger.error("Failed to migrate pull request {} to target github".format(pr.number))
+        finally:
+            # A closed pull request keeps its commits once its head branch is gone
+            if temporary:
+                try:
+                    migration.target_client.delete("{}/repos/{}/{}/git/refs/heads/{}".format(migration.target_api_url, migration.target_org, repo, head))
+                except Exception:
+                    logger.error("Failed to delete temporary branch {} of repo {} in target github".format(head, repo), exc_info=True)
 
+def create_pull_requests_concurrently(migration, prs):
+    """Create (repo, pull request) pairs from prs in the target with --pr-workers threads.
 
-def add_members_to_org(members, admins):
-    add_member = lambda mem, role : requests.request('PUT', headers=target_headers, json={"role": role}, url="{}/orgs/{}/memberships/{}".format(target_api_url, target_org, mem))
-    for mem in admins:
-        role = "admin"
-        res = add_member(mem, role)
-        if res.status_code in [200, 422]:
-            logger.info("Admin {} added/invited to organization {}".format(mem, target_org))
-        else:
-            logger.error("Failed to add {} as admin in target organization {}".format(mem, target_org))
-    for mem in members:
-        role = "member"
-        res = add_member(mem, role)
-        if res.status_code in [200, 422]:
-            logger.info("Member {} added/invited to organization {}".format(mem, target_org))
-        else:
-            logger.error("Failed to add {} as member in target organization {}".format(mem, target_org))
+    Comments of a pull request are still added in order by one worker, only
+    separate pull requests overlap. The queue between reading prs and
+    creating them is bounded so memory stays flat however many there are.
+    """
+    queue = Queue(maxsize=args.pr_workers * 2)
+    def create():
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            # A dead worker would leave the producer blocked on the full queue
+            try:
+                create_pull_requests(migration, *item)
+            except Exception:
+                logger.error("Failed to migrate pull request {} of repo {} to target github".format(item[1][0].number, item[0]), exc_info=True)
+
+    workers = [threading.Thread(target=create) for i in range(max(args.pr_workers, 1))]
+    for worker in workers:
+        worker.start()
+    try:
+        for repo, pr in prs:
+            queue.put((repo, [pr]))
+    finally:
+        for worker in workers:
+            queue.put(None)
+        for worker in workers:
+            worker.join()
 
+def migrate_pull_requests(migration, repo):
+    """Stream pull requests of repo from the source while they are created in the target."""
+    logger.info("Migrating pull requests of repo {} to target GitHub".format(repo))
+    try:
+        create_pull_requests_concurrently(migration, ((repo, pr) for pr in stream_pull_requests(migration, repo)))
+    except Exception:
+        logger.error("Failed to fetch pull requests from source repo: {}".format(repo), exc_info=True)
+    logger.info("Pull requests of repo {} migrated to target GitHub".format(repo))
+
+class GraphQLError(Exception):
+    pass
+
+graphql_repos_query = """
+query($org: String!, $cursor: String) {
+  organization(login: $org) {
+    repositories(first: 100, after: $cursor) {
+      pageInfo { hasNextPage endCursor }
+      nodes { name isPrivate description diskUsage pullRequests { totalCount } }
+    }
+  }
+}"""
+
+graphql_teams_query = """
+query($org: String!, $cursor: String) {
+  organization(login: $org) {
+    teams(first: 25, after: $cursor) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        slug
+        repositories(first: 100) { totalCount nodes { nameWithOwner } }
+        members(first: 100) { totalCount edges { role node { login } } }
+      }
+    }
+  }
+}"""
 
-def create_organization(url, name, user, token):
+graphql_pull_requests_query = """
+query($org: String!, $repo: String!, $cursor: String) {
+  repository(owner: $org, name: $repo) {
+    pullRequests(first: 20, after: $cursor, orderBy: {field: CREATED_AT, direction: ASC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        number title body createdAt state headRefName baseRefName
+        author { login }
+        assignees(first: 100) { totalCount nodes { login } }
+        reviewRequests(first: 100) { totalCount nodes { requestedReviewer { ... on User { login } } } }
+        comments(first: 100) { totalCount nodes { author { login } body updatedAt } }
+        reviews(first: 50) {
+          totalCount
+          nodes {
+            author { login } body submittedAt state
+            comments(first: 50) { totalCount nodes { author { login } body updatedAt path originalPosition originalCommit { oid } } }
+          }
+        }
+      }
+    }
+  }
+}"""
+
+# Nested connections are read one page deep, larger ones are left to REST
+truncated = lambda connection: connection["totalCount"] > len(connection["nodes"] if "nodes" in connection else connection["edges"])
+# Deleted users show up as a null author
+author_login = lambda node: node["author"]["login"] if node["author"] else "ghost"
+
+def graphql(migration, query, variables):
+    response = migration.source_client.post(migration.graphql_url, json={"query": query, "variables": variables})
+    if response.status_code != 200:
+        raise GraphQLError("{} returned {}".format(migration.graphql_url, response.status_code))
+    result = response.json()
+    if result.get("errors"):
+        raise GraphQLError("; ".join(error.get("message", "") for error in result["errors"]))
+    return result["data"]
+
+def graphql_nodes(migration, query, path, variables):
+    """Yield the nodes of the connection found at path in the result of query, following its cursor."""
+    cursor = None
+    while True:
+        connection = graphql(migration, query, dict(variables, cursor=cursor))
+        for key in path:
+            connection = connection[key]
+        yield from connection["nodes"]
+        if not connection["pageInfo"]["hasNextPage"]:
+            return
+        cursor = connection["pageInfo"]["endCursor"]
+
+def disable_graphql(migration, what, error):
+    logger.warning("GraphQL discovery of {} failed on {} ({}), using REST from now on".format(what, migration.source_url, error))
+    metrics.count("graphql_fallbacks")
+    migration.use_graphql = False
+
+def discover(migration, what, graphql_call, rest_call):
+    """Return graphql_call() when GraphQL discovery is enabled, rest_call() if it is not or GraphQL fails."""
+    if migration.use_graphql:
+        try:
+            return graphql_call()
+        except Exception as error:
+            disable_graphql(migration, what, error)
+    return rest_call()
+
+def graphql_list_org_repos(migration):
+    return [Repo(node["name"], node["isPrivate"], node["description"], node["diskUsage"] or 0, node["pullRequests"]["totalCount"]) for node in graphql_nodes(migration, graphql_repos_query, ["organization", "repositories"], {"org": migration.source_org})]
+
+def graphql_team_details(migration):
+    """Map team slugs to their repo full names, members and maintainers, leaving out teams too large for one query."""
+    details = {}
+    for team in graphql_nodes(migration, graphql_teams_query, ["organization", "teams"], {"org": migration.source_org}):
+        if truncated(team["repositories"]) or truncated(team["members"]):
+            continue
+        members = team["members"]["edges"]
+        details[team["slug"]] = ([repo["nameWithOwner"] for repo in team["repositories"]["nodes"]], [edge["node"]["login"] for edge in members], [edge["node"]["login"] for edge in members if edge["role"] == "MAINTAINER"])
+    return details
+
+def graphql_stream_pull_requests(migration, repo):
+    """Yield every pull request of repo with its comments and reviews, 20 pull requests per query."""
+    for node in graphql_nodes(migration, graphql_pull_requests_query, ["repository", "pullRequests"], {"org": migration.source_org, "repo": repo}):
+        reviews = node["reviews"]["nodes"]
+        if any(truncated(connection) for connection in [node["assignees"], node["reviewRequests"], node["comments"], node["reviews"]] + [review["comments"] for review in reviews]):
+            response = migration.source_client.get("{}/repos/{}/{}/pulls/{}".format(migration.source_api_url, migration.source_org, repo, node["number"]))
+            response.raise_for_status()
+            yield from build_pull_requests(migration, [response.json()])
+            continue
+        assignees = [item["login"] for item in node["assignees"]["nodes"]]
+        # Team review requests have no login
+        reviewers = [item["requestedReviewer"]["login"] for item in node["reviewRequests"]["nodes"] if item["requestedReviewer"] and "login" in item["requestedReviewer"]]
+        comments = [Comment(author_login(item), item["body"], item["updatedAt"], migration.target_url) for item in node["comments"]["nodes"]]
+        review_comments = [ReviewComment(author_login(item), item["body"], item["updatedAt"], item["originalCommit"]["oid"] if item["originalCommit"] else None, item["originalPosition"], item["path"], migration.target_url) for review in reviews for item in review["comments"]["nodes"]]
+        reviews = [Review(author_login(item), item["body"], item["submittedAt"], item["state"], migration.target_url) for item in reviews if item["body"] != ""]
+        yield pull_request(node["number"], author_login(node), node["title"], node["body"], node["createdAt"], node["headRefName"], node["baseRefName"], assignees, reviewers, reviews, review_comments, comments, migration.target_url, {"OPEN": "open", "MERGED": "merged"}.get(node["state"], "closed"))
+
+def fetch_target_roles(migration):
+    roles = {}
+    members_url = "{}/orgs/{}/members".format(migration.target_api_url, migration.target_org)
+    for role in ["member", "admin"]:
+        for mem in paginate(migration.target_client, members_url, {"role": role}):
+            roles[mem["login"]] = role
+    try:
+        for invitation in paginate(migration.target_client, "{}/orgs/{}/invitations".format(migration.target_api_url, migration.target_org)):
+            if invitation["login"]:
+                roles.setdefault(invitation["login"], "admin" if invitation["role"] == "admin" else "member")
+    except Exception:
+        logger.warning("Could not list pending invitations of target organization {}".format(migration.target_org))
+    return roles
+
+def plan_membership_changes(migration, members, admins, target_roles):
+    already_added = lambda mem, role: migration.journal.is_done("member", mem) and migration.journal.get("member", mem)["role"] == role
+    planned = []
+    for role, logins in [("admin", admins), ("member", members)]:
+        for mem in logins:
+            if target_roles.get(mem) != role and not already_added(mem, role):
+                planned.append((mem, role))
+    return planned
+
+def add_members_to_org(migration, members, admins):
+    # Each member is journalled as soon as it is in place, so one failure does not lose the others
+    def add_member(mem, role):
+        try:
+            res = migration.target_client.put("{}/orgs/{}/memberships/{}".format(migration.target_api_url, migration.target_org, mem), json={"role": role})
+        except Exception:
+            logger.error("Failed to add {} as {} in target organization {}".format(mem, role, migration.target_org), exc_info=True)
+            return None
+        if res.status_code not in [200, 422]:
+            logger.error("Failed to add {} as {} in target organization {}".format(mem, role, migration.target_org))
+            return None
+        migration.journal.record("member", mem, role=role)
+        logger.info("{} {} added/invited to organization {}".format(role.capitalize(), mem, migration.target_org))
+        return res
+    try:
+        target_roles = fetch_target_roles(migration)
+    except Exception:
+        logger.warning("Could not list members of target organization {}, every member will be added".format(migration.target_org))
+        target_roles = {}
+    planned = plan_membership_changes(migration, members, admins, target_roles)
+    role_changes = [mem for mem, role in planned if mem in target_roles]
+    logger.info("Membership plan for {}: {} to add, {} role changes, {} already in place".format(migration.target_org, len(planned) - len(role_changes), len(role_changes), len(members) + len(admins) - len(planned)))
+    for mem, role in planned:
+        logger.info("{} {} as {} in organization {}".format("Change role of" if mem in target_roles else "Add", mem, role, migration.target_org))
+    if args.dry_run:
+        return
+    gather([partial(add_member, mem, role) for mem, role in planned])
+
+
+def create_organization(client, name, user):
     data_dict = {}
     data_dict['login'] = name
     data_dict['admin'] = user
     data = json.dumps(data_dict)
     status = True
     try:
-        headers = {"Authorization" : "token {}".format(token)}
-        response = requests.request("POST", data=data, headers=headers, url="{}/admin/organizations".format(url))
+        response = client.post("{}/admin/organizations".format(client.api_url), data=data)
         status = False if response.status_code != 200 else True
     except Exception:
         logger.error("Exception occurred: ", exc_info=True)
         status = False
     return status
 
-def create_repo(url, org, repo, token):
+def create_repo(client, org, repo):
     status = True
     try:
-        headers = {"Authorization" : "token {}".format(token)}
-        response = requests.request("POST", headers=headers, data=json.dumps(vars(repo)), url="{}/orgs/{}/repos".format(url, org))
+        data = {"name": repo.name, "private": repo.private, "description": repo.description}
+        response = client.post("{}/orgs/{}/repos".format(client.api_url, org), data=json.dumps(data))
         if response.status_code == 422:
             status = True if "already exists" in response.json()["errors"][0]["message"] else False
             logger.info("Repo {} already exists in target GitHub's organization {}".format(repo.name, org))
@@ -321,96 +1012,620 @@ def create_repo(url, org, repo, token):
         status = False
     return status
 
-def sync_single_repo(repo):
+git_config_args = [arg for option in args.git_config for arg in ["-c", option]]
+
+# Strip user:token@ from urls so failed commands can be logged safely
+redact = lambda command: [re.sub(r"://[^/@]+@", "://", arg) for arg in command]
+
+def run_git(git_args, cwd=None, output=False):
+    command = ["git"] + git_config_args + git_args
+    try:
+        if output:
+            return subprocess.check_output(command, cwd=cwd, universal_newlines=True)
+        subprocess.check_call(command, cwd=cwd)
+    except subprocess.CalledProcessError as error:
+        raise subprocess.CalledProcessError(error.returncode, redact(command)) from None
+
+def run_git_with_retry(git_args, cwd=None):
+    attempt = 0
+    while True:
+        try:
+            return run_git(git_args, cwd=cwd)
+        except subprocess.CalledProcessError:
+            if attempt >= args.git_retries:
+                raise
+            delay = 2 ** attempt + random.uniform(0, 1)
+            logger.warning("git {} failed, retrying in {:.1f}s".format(git_args[0], delay))
+            metrics.count("git_retries")
+            time.sleep(delay)
+            attempt += 1
+
+def read_refs(git_dir):
+    """Read the refs of a bare repo straight from packed-refs and the loose ref files."""
+    refs = {}
+    packed_refs = os.path.join(git_dir, "packed-refs")
+    if os.path.exists(packed_refs):
+        with open(packed_refs) as f:
+            for line in f:
+                # Skip the header and peeled tag lines
+                if line.startswith("#") or line.startswith("^"):
+                    continue
+                sha, ref = line.rstrip("\n").split(" ", 1)
+                refs[ref] = sha
+    for root, dirs, files in os.walk(os.path.join(git_dir, "refs")):
+        for name in files:
+            path = os.path.join(root, name)
+            with open(path) as f:
+                sha = f.read().strip()
+            # Loose refs take precedence over packed ones, symbolic refs are skipped
+            if not sha.startswith("ref:"):
+                refs[os.path.relpath(path, git_dir).replace(os.sep, "/")] = sha
+    return refs
+
+def list_remote_refs(url):
+    output = run_git(["ls-remote", url], output=True)
+    refs = {}
+    for line in output.splitlines():
+        sha, ref = line.split("\t", 1)
+        if ref.startswith("refs/") and not ref.endswith("^{}"):
+            refs[ref] = sha
+    return refs
+
+ref_pattern = lambda pattern: re.compile("^" + "(.*)".join(re.escape(part) for part in pattern.split("*")) + "$")
+
+class RefRules():
+    """Decide which refs are pushed and under which name on the target.
+
+    Refs must match an include pattern, when any are given, and no exclude
+    pattern. The first matching FROM=TO rename rule then maps the part
+    matched by * in FROM into the * of TO.
+    """
+    def __init__(self, include, exclude, rename):
+        self.include = [ref_pattern(pattern) for pattern in include]
+        self.exclude = [ref_pattern(pattern) for pattern in exclude]
+        self.rename = [(ref_pattern(rule.split("=", 1)[0]), rule.split("=", 1)[1]) for rule in rename]
+        self.reverse = [(ref_pattern(rule.split("=", 1)[1]), rule.split("=", 1)[0]) for rule in rename]
+
+    def target_name(self, ref):
+        if self.include and not any(pattern.match(ref) for pattern in self.include):
+            return None
+        if any(pattern.match(ref) for pattern in self.exclude):
+            return None
+        for pattern, target in self.rename:
+            match = pattern.match(ref)
+            if match:
+                return target.replace("*", match.group(1))
+        return ref
+
+    def produces(self, target_ref):
+        """Whether some source ref would be pushed as target_ref, i.e. the ref is managed by these rules."""
+        candidates = [target_ref]
+        for pattern, source in self.reverse:
+            match = pattern.match(target_ref)
+            if match:
+                candidates.append(source.replace("*", match.group(1)) if match.groups() else source)
+        return any(self.target_name(ref) == target_ref for ref in candidates)
+
+    def apply(self, refs):
+        """Map target ref name to (local ref, sha) for every ref that is pushed."""
+        rewritten = {}
+        for ref, sha in refs.items():
+            target_ref = self.target_name(ref)
+            if target_ref:
+                rewritten[target_ref] = (ref, sha)
+        return rewritten
+
+ref_rules = RefRules(args.ref_include, args.ref_exclude, args.ref_rename)
+
+is_large = lambda repo: repo.size >= args.large_repo_size * 1024
+
+# Keeps a single git push command line well below the OS argument size limit
+max_refspecs_per_push = 5000
+
+def ref_updates(source_refs, target_refs, changed_only=True):
+    """Refspecs that make target_refs match source_refs, a mapping of target ref name to (local ref, sha)."""
+    refspecs = ["+{}:{}".format(ref, target_ref) for target_ref, (ref, sha) in sorted(source_refs.items()) if not changed_only or target_refs.get(target_ref) != sha]
+    # Only refs the --ref-* rules could have pushed are deleted, filtered out ones are left alone.
+    # refs/pull/ is read-only on GitHub and cannot be deleted
+    refspecs += [":" + target_ref for target_ref in sorted(target_refs) if target_ref not in source_refs and ref_rules.produces(target_ref) and not target_ref.startswith("refs/pull/")]
+    return refspecs
+
+def push_in_batches(migration, git_dir, target, refspecs, batch_size):
+    """Push refspecs batch_size at a time, branches first and tags last, retrying only the batches that fail."""
+    order = lambda refspec: 2 if ":refs/tags/" in refspec else 0 if ":refs/heads/" in refspec else 1
+    refspecs = sorted(refspecs, key=order)
+    batch_size = max(batch_size, 1)
+    batches = [refspecs[i:i + batch_size] for i in range(0, len(refspecs), batch_size)]
+    for number, batch in enumerate(batches, 1):
+        logger.info("Pushing batch {}/{} ({} refs) to target GitHub {}".format(number, len(batches), len(batch), migration.target_url))
+        run_git_with_retry(["push", target] + batch, cwd=git_dir)
+
+def push_refs(migration, repo, git_dir, target):
+    """Push the refs of git_dir selected and renamed by the --ref-* rules to target.
+
+    Refs on the target that no longer exist in the source are deleted.
+    With --incremental, and for large repos, refs already matching the
+    target are left out; large repos are also pushed --push-batch-size refs
+    at a time. Returns the pushed target ref names and their SHAs.
+    """
+    source_refs = ref_rules.apply(read_refs(git_dir))
+    if not source_refs:
+        logger.info("Empty repository found, ignoring...")
+        return {}
+    refspecs = ref_updates(source_refs, list_remote_refs(target), changed_only=args.incremental or is_large(repo))
+    if refspecs:
+        logger.info("Pushing {} refs of repo {} to target GitHub {}".format(len(refspecs), repo.name, migration.target_url))
+        with metrics.phase("repo_push", repo_key(migration, repo.name)):
+            push_in_batches(migration, git_dir, target, refspecs, args.push_batch_size if is_large(repo) else max_refspecs_per_push)
+        metrics.count("refs_pushed", len(refspecs))
+        logger.info("Push activity completed successfully!!!")
+    else:
+        logger.info("Repo {} is up to date in target GitHub {}".format(repo.name, migration.target_url))
+    return {target_ref: sha for target_ref, (ref, sha) in source_refs.items()}
+
+def parse_size(size):
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    size = size.strip().upper().rstrip("B")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+def dir_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+class MirrorCache():
+    """Bare mirrors under root, locked while in use and evicted least recently used first beyond max_bytes."""
+    def __init__(self, root, max_bytes=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.evict_lock = threading.Lock()
+        # Mirror path to [size, last use], loaded lazily
+        self.index = None
+
+    def path(self, migration, repo):
+        return os.path.join(self.root, urlparse(migration.source_url).netloc, migration.source_org, repo.name + ".git")
+
+    @contextmanager
+    def mirror(self, migration, repo):
+        path = self.path(migration, repo)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # The sibling lock file keeps concurrent runs apart and its mtime records the last use
+        with open(path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                os.utime(path + ".lock")
+                yield path
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        self.evict(path)
+
+    def mirrors(self):
+        for root, dirs, files in os.walk(self.root):
+            for name in list(dirs):
+                if name.endswith(".git"):
+                    dirs.remove(name)
+                    yield os.path.join(root, name)
+
+    def load_index(self):
+        last_used = lambda path: os.path.getmtime(path + ".lock") if os.path.exists(path + ".lock") else 0
+        self.index = {path: [dir_size(path), last_used(path)] for path in self.mirrors()}
+
+    def evict(self, used):
+        """Record the new size of the mirror at used and evict least recently used mirrors above the budget."""
+        if self.max_bytes is None:
+            return
+        with self.evict_lock:
+            # Scan every mirror once, then only remeasure the one just used
+            if self.index is None:
+                self.load_index()
+            self.index[used] = [dir_size(used), time.time()]
+            total = sum(size for size, last_used in self.index.values())
+            if total <= self.max_bytes:
+                return
+            for path in sorted(self.index, key=lambda path: self.index[path][1]):
+                if total <= self.max_bytes:
+                    break
+                if path == used:
+                    continue
+                with open(path + ".lock", "a") as lock:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:
+                        continue
+                    try:
+                        size = self.index.pop(path)[0]
+                        # Another run sharing the cache may have evicted it already
+                        if os.path.exists(path):
+                            logger.info("Evicting mirror {} ({} bytes) from cache".format(path, size))
+                            shutil.rmtree(path)
+                        total -= size
+                    finally:
+                        fcntl.flock(lock, fcntl.LOCK_UN)
+            if total > self.max_bytes:
+                logger.warning("Mirror cache {} is {} bytes, above its {} byte budget".format(self.root, total, self.max_bytes))
+
+mirror_cache = MirrorCache(cache_dir, parse_size(args.cache_size) if args.cache_size else None) if cache_dir else None
+
+# Repo names are only unique within one organization
+# Repos of different migrations in one batch can share a name, even within one source org
+repo_key = lambda migration, name: "{}/{}/{} -> {}/{}".format(fetch_url_from_api(migration.source_api_url), migration.source_org, name, fetch_url_from_api(migration.target_api_url), migration.target_org)
+
+def sync_cached(migration, repo, source, target):
+    """Bring the cached mirror of repo up to date from source and push it to target."""
+    with mirror_cache.mirror(migration, repo) as mirror_dir:
+        if os.path.exists(mirror_dir):
+            logger.info("Cache hit for repo {}, fetching changes into {}".format(repo.name, mirror_dir))
+            # A shallow mirror cannot be pushed, complete its history first
+            unshallow = ["--unshallow"] if os.path.exists(os.path.join(mirror_dir, "shallow")) else []
+            size = dir_size(mirror_dir)
+            with metrics.phase("repo_fetch", repo_key(migration, repo.name)):
+                run_git_with_retry(["fetch", "--prune"] + unshallow + [source, "+refs/*:refs/*"], cwd=mirror_dir)
+            metrics.count("git_bytes_fetched", max(dir_size(mirror_dir) - size, 0))
+            metrics.count("cache_hits")
+        else:
+            logger.info("Cache miss for repo {}, cloning into {}".format(repo.name, mirror_dir))
+            # Clone next to the mirror and move it into place once complete, so a killed
+            # run never leaves a half-cloned mirror behind that later runs take as a hit
+            partial_dir = mirror_dir + ".partial"
+            if os.path.exists(partial_dir):
+                shutil.rmtree(partial_dir)
+            with metrics.phase("repo_clone", repo_key(migration, repo.name)):
+                run_git_with_retry(["clone", "--mirror", source, partial_dir])
+            metrics.count("git_bytes_fetched", dir_size(partial_dir))
+            metrics.count("cache_misses")
+            # Keep credentials out of the persisted config, fetches pass the url explicitly
+            run_git(["remote", "set-url", "origin", "{}/{}/{}.git".format(migration.source_url, migration.source_org, repo.name)], cwd=partial_dir)
+            os.rename(partial_dir, mirror_dir)
+        return push_refs(migration, repo, mirror_dir, target)
+
+def sync_temporary(migration, repo, source, target):
+    """Mirror repo from source to target through a throwaway clone."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        logger.info("Created temporary directory for cloning: {}".format(temp_dir))
+        logger.info("Cloning source repo {} to temporary directory".format(repo.name))
+        with metrics.phase("repo_clone", repo_key(migration, repo.name)):
+            run_git_with_retry(["clone", "--mirror", source, temp_dir])
+        metrics.count("git_bytes_fetched", dir_size(temp_dir))
+        logger.info("Cloning completed successfully!!!")
+        return push_refs(migration, repo, temp_dir, target)
+
+def sync_single_repo(migration, repo, migrate_prs=False):
     pluck_http_out_of_url = lambda url: url if "http" not in url else url.split("://")[1]
-    create_git_url = lambda user, token, url, org, name : "https://{}:{}@{}/{}/{}.git".format(user, token, pluck_http_out_of_url(url), org, name)
-    source = create_git_url(user, source_token, source_url, source_org, repo.name)
-    target = create_git_url(user, target_token, target_url, target_org, repo.name)
-    logger.info("Creating repository {} in target GitHub {}".format(repo.name, fetch_url_from_api(target_api_url)))
-    if create_repo(target_api_url, target_org, repo, target_token):
-        cwd = os.getcwd()
+    create_git_url = lambda user, token, url, org, name : "{}://{}:{}@{}/{}/{}.git".format(urlparse(url).scheme or "https", user, token, pluck_http_out_of_url(url), org, name)
+    source = create_git_url(migration.user, migration.source_token, migration.source_url, migration.source_org, repo.name)
+    target = create_git_url(migration.user, migration.target_token, migration.target_url, migration.target_org, repo.name)
+    # GraphQL discovery already tells which repos have no pull requests
+    migrate_prs = migrate_prs and getattr(repo, "pull_requests", None) != 0
+    if migration.journal.is_done("repo", repo.name):
+        logger.info("Repo {} already mirrored, skipping".format(repo.name))
+        if migrate_prs:
+            # Pull requests are journalled one by one, pick up any left over
+            migrate_pull_requests(migration, repo.name)
+        return True
+    logger.info("Creating repository {} in target GitHub {}".format(repo.name, fetch_url_from_api(migration.target_api_url)))
+    if create_repo(migration.target_client, migration.target_org, repo):
         try:
-            with tempfile.TemporaryDirectory() as temp_dir:
-                logger.info("Created temporary directory for cloning: {}".format(temp_dir))
-                logger.info("Cloning source repo {} to temporary directory".format(repo.name))
-                subprocess.call(["git", "clone", "--mirror", source, temp_dir])
-                logger.info("Cloning completed successfully!!!")
-                os.chdir(temp_dir)
-                logger.info("Modifying origin url to {}/{}/{}.git".format(target_url, target_org, repo.name))
-                subprocess.call(["git", "remote", "rm", "origin"])
-                subprocess.call(["git", "remote", "add", "origin", target])
-                logger.info("origin modified successfully!!!")
-                if os.path.exists("packed-refs"):
-                    logger.info("Modifying hidden refs to hidden branches to create pull requests")
-                    subprocess.call(["sed", "-i.bak", "s/pull/pr/g", "packed-refs"])
-                    logger.info("Modified to hidden branches successfully")
-                    logger.info("Pushing code, branches and tags to target GitHub {}".format(target_url))
-                    subprocess.call(["git", "push", "--mirror"])
-                    logger.info("Push activity completed successfully!!!")
-                    #source_prs = fetch_pull_requests(repo.name)
-                else:
-                    logger.info("Empty repository found, ignoring...")
-
-                    #create_pull_requests(repo.name, source_prs)
-                logger.info("Repo {} mirrored successfully in target GitHub {}".format(repo.name, target_org))
+            if mirror_cache:
+                refs = sync_cached(migration, repo, source, target)
+            else:
+                refs = sync_temporary(migration, repo, source, target)
+            migration.journal.record("repo", repo.name, refs=refs)
+            logger.info("Repo {} mirrored successfully in target GitHub {}".format(repo.name, migration.target_org))
+            if migrate_prs:
+                with metrics.phase("pr_migration", repo_key(migration, repo.name)):
+                    migrate_pull_requests(migration, repo.name)
+            return True
         except Exception:
             logger.error("Exception occurred: ", exc_info=True)
-        finally:
-            os.chdir(cwd)
     else:
-        logger.error("Repo {} creation failed in target GitHub {}".format(repo.name, fetch_url_from_api(target_api_url)))
+        logger.error("Repo {} creation failed in target GitHub {}".format(repo.name, fetch_url_from_api(migration.target_api_url)))
+    return False
 
-def create_repo_obj_from_name(repo):
+def create_repo_obj_from_name(migration, repo):
     repo_obj = None
     try:
-        resp = requests.get(url="{}/repos/{}/{}".format(source_api_url, source_org, repo), headers=source_headers)
+        resp = migration.source_client.get("{}/repos/{}/{}".format(migration.source_api_url, migration.source_org, repo))
         if resp.status_code == 200:
             res = resp.json()
-            repo_obj = Repo(res['name'], res['private'], res['description'])
+            repo_obj = Repo(res['name'], res['private'], res['description'], res['size'])
     except Exception:
         pass
     return repo_obj
 
-def sync_repos(repos_list):
-    logger.info("Repos to be synced: {}".format(",".join(str(repo) for repo in repos_list)))
-    
-    for repo in repos_list:
-        logger.info("Starting sync for repo: {}".format(repo.name))
-        
-        sync_single_repo(repo)    
+def sync_repos(work, jobs=1, migrate_prs=False):
+    """Sync (migration, repo) pairs, jobs at a time, and return whether each succeeded keyed by (migration, repo name).
 
-if __name__ == '__main__':
-    logger.info("Source git: {} Source Organization: {}".format(fetch_url_from_api(source_api_url), source_org))
-    logger.info("Target git: {} Target Organization: {}".format(fetch_url_from_api(target_api_url), target_org))
+    The largest repos are started first so a big repo picked up last does
+    not leave the other workers idle while it finishes.
+    """
+    work = sorted(work, key=lambda item: -item[1].size)
+    logger.info("Repos to be synced: {}".format(",".join(repo_key(migration, repo.name) for migration, repo in work)))
+    results = {}
+    start = time.time()
 
-    repos_list = args.repos
-    if repos_list is None:
-        repos_list = list_org_repos(source_api_url, source_org, source_token)
-    else:
-        repos = []
+    def sync(migration, repo):
+        logger.info("Starting sync for repo: {}".format(repo_key(migration, repo.name)))
+        try:
+            with metrics.phase("repo_sync", repo_key(migration, repo.name)):
+                return sync_single_repo(migration, repo, migrate_prs)
+        except Exception:
+            logger.error("Sync failed for repo: {}".format(repo_key(migration, repo.name)), exc_info=True)
+            return False
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = {executor.submit(sync, migration, repo): (migration, repo) for migration, repo in work}
+        for future in as_completed(futures):
+            (migration, repo) = futures[future]
+            results[(migration, repo.name)] = future.result()
+
+    elapsed = time.time() - start
+    succeeded = [key for key, ok in results.items() if ok]
+    failed = sorted(repo_key(migration, name) for (migration, name), ok in results.items() if not ok)
+    logger.info("Repo sync finished in {:.1f}s: {} succeeded, {} failed ({:.2f} repos/min)".format(elapsed, len(succeeded), len(failed), len(results) * 60 / elapsed if elapsed else 0))
+    if failed:
+        logger.error("Repos failed to sync: {}".format(",".join(failed)))
+    metrics.count("repos_synced", len(succeeded))
+    metrics.count("repos_failed", len(failed))
+    return results
+
+def write_reports():
+    report = metrics.report()
+    for name, phase in sorted(report["phases"].items(), key=lambda item: -item[1]["seconds"]):
+        logger.info("Phase {}: {:.1f}s over {} runs".format(name, phase["seconds"], phase["count"]))
+    try:
+        metrics.write_json(report_file)
+        logger.info("Run report written to {}".format(report_file))
+        if args.prometheus_file:
+            metrics.write_prometheus(args.prometheus_file)
+    except Exception:
+        logger.error("Failed to write run report", exc_info=True)
+
+def restore(cls, fields):
+    """Rebuild an object saved with vars() without running __init__, whose bodies are already formatted."""
+    obj = cls.__new__(cls)
+    obj.__dict__.update(fields)
+    return obj
+
+def pull_request_record(repo, pr):
+    record = dict(vars(pr), type="pull_request", repo=repo)
+    for name in ["comments", "reviews", "review_comments"]:
+        record[name] = [vars(comment) for comment in getattr(pr, name)]
+    return record
+
+def pull_request_from_record(record):
+    pr = restore(pull_request, {name: value for name, value in record.items() if name not in ["type", "repo"]})
+    pr.comments = [restore(Comment, fields) for fields in record["comments"]]
+    pr.reviews = [restore(Review, fields) for fields in record["reviews"]]
+    pr.review_comments = [restore(ReviewComment, fields) for fields in record["review_comments"]]
+    return pr
+
+def export_snapshot(migration, path, repos_list, include_prs=False):
+    """Write members, teams, repos and optionally pull requests of the source org to a gzipped JSON lines snapshot.
+
+    Pull requests of different repos are exported concurrently, --jobs
+    repos at a time, and written as they arrive. Any section that cannot
+    be read fails the export, and the snapshot only replaces path once it
+    is complete, so an import never applies a partial one.
+    """
+    lock = threading.Lock()
+    failed = []
+    with gzip.open(path + ".tmp", "wt") as f:
+        def write(record):
+            with lock:
+                f.write(json.dumps(record) + "\n")
+
+        write({"type": "header", "version": 1, "source": fetch_url_from_api(migration.source_api_url), "source_org": migration.source_org, "created": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")})
+        (members, admins) = fetch_org_members(migration, strict=True)
+        for role, logins in [("admin", admins), ("member", members)]:
+            for login in logins:
+                write({"type": "member", "login": login, "role": role})
+        for team in fetch_source_teams(migration, strict=True):
+            write(dict(vars(team), type="team"))
         for repo in repos_list:
-            repos.append(create_repo_obj_from_name(repo))
+            write(dict(vars(repo), type="repo"))
+        if include_prs:
+            def export_prs(repo):
+                logger.info("Exporting pull requests of repo {}".format(repo.name))
+                for pr in stream_pull_requests(migration, repo.name):
+                    write(pull_request_record(repo.name, pr))
+            with_prs = [repo for repo in repos_list if getattr(repo, "pull_requests", None) != 0]
+            with ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as executor:
+                for repo, future in [(repo, executor.submit(export_prs, repo)) for repo in with_prs]:
+                    try:
+                        future.result()
+                    except Exception:
+                        logger.error("Failed to export pull requests of repo {}".format(repo.name), exc_info=True)
+                        failed.append(repo.name)
+    if failed:
+        raise Exception("Pull requests of repos {} could not be exported".format(",".join(failed)))
+    os.replace(path + ".tmp", path)
+    logger.info("Snapshot of organization {} written to {}".format(migration.source_org, path))
+
+def read_snapshot(path):
+    with gzip.open(path, "rt") as f:
+        for line in f:
+            yield json.loads(line)
+
+def read_snapshot_metadata(path):
+    """Load members, admins, teams and repos of a snapshot, everything but its pull requests."""
+    members, admins, teams, repos = [], [], [], []
+    for record in read_snapshot(path):
+        kind = record.pop("type")
+        if kind == "member":
+            (admins if record["role"] == "admin" else members).append(record["login"])
+        elif kind == "team":
+            teams.append(restore(Team, record))
+        elif kind == "repo":
+            repos.append(restore(Repo, record))
+        elif kind == "header":
+            logger.info("Importing snapshot of {}/{} taken {}".format(record["source"], record["source_org"], record["created"]))
+    return (members, admins, teams, repos)
+
+def import_pull_requests(migration, path, repo_names):
+    """Create the snapshot's pull requests of repo_names in the target, streaming them from disk."""
+    logger.info("Importing pull requests from snapshot {}".format(path))
+    records = (record for record in read_snapshot(path) if record["type"] == "pull_request" and record["repo"] in repo_names)
+    create_pull_requests_concurrently(migration, ((record["repo"], pull_request_from_record(record)) for record in records))
+
+def list_source_repos(migration):
+    """Source repos selected by the migration's repo patterns, or None if they cannot be listed."""
+    if migration.repos and not any(has_wildcard(pattern) for pattern in migration.repos):
+        repos = []
+        for repo in migration.repos:
+            repos.append(create_repo_obj_from_name(migration, repo))
         repos_list = [ repo for repo in repos if repo != None]
+    else:
+        repos_list = discover(migration, "repos", partial(graphql_list_org_repos, migration), partial(list_org_repos, migration.source_client, migration.source_org))
+        if repos_list is None:
+            return None
+    return [repo for repo in repos_list if migration.wants(repo.name)]
+
+def setup_target(migration, command="migrate"):
+    """Make sure the target organization exists and migrate members and teams, taken from the snapshot on import.
 
-    #print(repos_list)
+    Returns the repos left to sync, or None if the organization cannot be migrated.
+    """
+    if command == "import":
+        (members, admins, teams, repos_list) = read_snapshot_metadata(migration.snapshot_file)
+        repos_list = [repo for repo in repos_list if migration.wants(repo.name)]
+    else:
+        with metrics.phase("repo_list"):
+            repos_list = list_source_repos(migration)
+        if repos_list is None:
+            logger.error("Failed to list repos of source organization {}".format(migration.source_org))
+            return None
     # Verify if target organization is available
-    target_repos_list = list_org_repos(target_api_url, target_org, target_token)
+    target_repos_list = list_org_repos(migration.target_client, migration.target_org)
     if target_repos_list is None:
-        if args.site_admin:
-            logger.info("Creating organization {} in target GitHub: {}".format(target_org, fetch_url_from_api(target_api_url)))
-            if create_organization(target_api_url, target_org, args.site_admin, target_token):
-                logger.info("Organization {} created successfully in target GitHub {}".format(target_org, fetch_url_from_api(target_api_url)))
+        if args.dry_run:
+            logger.info("Dry run: organization {} would be created in target GitHub {}".format(migration.target_org, fetch_url_from_api(migration.target_api_url)))
+        elif migration.site_admin:
+            logger.info("Creating organization {} in target GitHub: {}".format(migration.target_org, fetch_url_from_api(migration.target_api_url)))
+            if create_organization(migration.target_client, migration.target_org, migration.site_admin):
+                logger.info("Organization {} created successfully in target GitHub {}".format(migration.target_org, fetch_url_from_api(migration.target_api_url)))
             else:
-                logger.error("Failed to create organization {} in target GitHub {}".format(target_org, fetch_url_from_api(target_api_url)))
+                logger.error("Failed to create organization {} in target GitHub {}".format(migration.target_org, fetch_url_from_api(migration.target_api_url)))
+                return None
+        else:
+            return None
+    else:
+        logger.info("Organization {} exists in target GitHub: {}".format(migration.target_org, fetch_url_from_api(migration.target_api_url)))
+
+    if command == "migrate":
+        with metrics.phase("member_fetch"):
+            (members,admins) = fetch_org_members(migration)
+    with metrics.phase("member_sync"):
+        add_members_to_org(migration, members,admins)
+    if args.dry_run:
+        return repos_list
+    if command == "migrate":
+        with metrics.phase("team_fetch"):
+            teams = fetch_source_teams(migration)
+    with metrics.phase("team_create"):
+        create_teams(migration, teams)
+    return repos_list
+
+def try_setup_target(migration, command="migrate"):
+    """Run setup_target, reporting an organization whose setup raised as failed so the others carry on."""
+    try:
+        return setup_target(migration, command)
+    except Exception:
+        logger.error("Setup of organization {} failed".format(migration), exc_info=True)
+        return None
+
+def load_manifest(path):
+    """Read the migrations listed in a JSON or YAML batch manifest.
+
+    Command line options fill in the urls, user, tokens, repos, site admin
+    and discovery an entry leaves out. Per host concurrency budgets under
+    host_concurrency are applied before any client is created.
+    """
+    with open(path) as f:
+        if path.endswith((".yaml", ".yml")):
+            if yaml is None:
+                logger.error("PyYAML is required to read {}, install it with pip install pyyaml or use a JSON manifest".format(path))
                 sys.exit(1)
+            manifest = yaml.safe_load(f)
         else:
+            manifest = json.load(f)
+    for host, concurrency in manifest.get("host_concurrency", {}).items():
+        set_host_concurrency(host, concurrency)
+    option = lambda entry, name: entry.get(name, getattr(args, name))
+    migrations = []
+    state_files = {}
+    for number, entry in enumerate(manifest["migrations"], 1):
+        missing = [name for name in ["source_url", "target_url", "user", "source_token", "target_token"] if option(entry, name) is None]
+        if "source_org" not in entry:
+            missing.insert(0, "source_org")
+        if missing:
+            logger.error("Migration {} of manifest {} is missing {}".format(number, path, ",".join(missing)))
             sys.exit(1)
+        # Organizations of the same name on different hosts would otherwise write one journal
+        state_file = entry.get("state_file") or default_state_file(entry["source_org"], entry.get("target_org") or entry["source_org"])
+        if state_file in state_files:
+            logger.error("Migrations {} and {} of manifest {} share state file {}, give one of them its own state_file".format(state_files[state_file], number, path, state_file))
+            sys.exit(1)
+        state_files[state_file] = number
+        migrations.append(Migration(option(entry, "source_url"), entry["source_org"], option(entry, "target_url"), entry.get("target_org"), option(entry, "user"), option(entry, "source_token"), option(entry, "target_token"),
+                                    option(entry, "repos"), entry.get("exclude_repos"), option(entry, "site_admin"), state_file, discovery=option(entry, "discovery")))
+    return migrations
+
+if __name__ == '__main__':
+    atexit.register(write_reports)
+    if args.command == "batch":
+        migrations = load_manifest(args.manifest)
     else:
-        logger.info("Organization {} exists in target GitHub: {}".format(target_org, fetch_url_from_api(target_api_url)))
-    
-    (members,admins) = fetch_org_members()
-    add_members_to_org(members,admins)
-    teams = fetch_source_teams()
-    create_teams(teams) 
-    sync_repos(repos_list)  
-    logger.info("Organization {} migrated from Source {} to Target {} successfully!".format(source_org, fetch_url_from_api(source_api_url), fetch_url_from_api(target_api_url))) 
+        migrations = [Migration(args.source_url, args.source_org, args.target_url, args.target_org, args.user, args.source_token, args.target_token, args.repos,
+                                site_admin=args.site_admin, state_file=args.state_file, snapshot_file=args.snapshot, discovery=args.discovery)]
+    for migration in migrations:
+        logger.info("Source git: {} Source Organization: {}".format(fetch_url_from_api(migration.source_api_url), migration.source_org))
+        logger.info("Target git: {} Target Organization: {}".format(fetch_url_from_api(migration.target_api_url), migration.target_org))
+        metrics.migrations.append({"source": "{}/{}".format(fetch_url_from_api(migration.source_api_url), migration.source_org), "target": "{}/{}".format(fetch_url_from_api(migration.target_api_url), migration.target_org)})
+
+    if args.command == "export":
+        migration = migrations[0]
+        with metrics.phase("repo_list"):
+            repos_list = list_source_repos(migration)
+        if repos_list is None:
+            logger.error("Failed to list repos of source organization {}".format(migration.source_org))
+            sys.exit(1)
+        with metrics.phase("export"):
+            try:
+                export_snapshot(migration, migration.snapshot_file, repos_list, args.migrate_prs)
+            except Exception as error:
+                logger.error("Export of organization {} failed, no snapshot written: {}".format(migration.source_org, error))
+                if os.path.exists(migration.snapshot_file + ".tmp"):
+                    os.remove(migration.snapshot_file + ".tmp")
+                sys.exit(1)
+        sys.exit(0)
+
+    command = "import" if args.command == "import" else "migrate"
+    # Organizations are set up side by side, their repos then share one pool of --jobs workers
+    with ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as executor:
+        prepared = list(executor.map(partial(try_setup_target, command=command), migrations))
+    failed = [migration for migration, repos_list in zip(migrations, prepared) if repos_list is None]
+    for migration in failed:
+        logger.error("Organization {} cannot be migrated to target GitHub {}".format(migration.target_org, fetch_url_from_api(migration.target_api_url)))
+    if args.dry_run:
+        logger.info("Dry run finished, teams and repos were not migrated")
+        sys.exit(1 if failed else 0)
+    work = [(migration, repo) for migration, repos_list in zip(migrations, prepared) if repos_list for repo in repos_list]
+    with metrics.phase("repo_sync_total"):
+        # Imported pull requests come from the snapshot once every repo is pushed
+        results = sync_repos(work, args.jobs, args.migrate_prs and command == "migrate")
+    if command == "import" and args.migrate_prs:
+        with metrics.phase("pr_migration"):
+            for migration in migrations:
+                import_pull_requests(migration, migration.snapshot_file, set(name for (synced, name), ok in results.items() if synced is migration and ok))
+    for migration in migrations:
+        if migration not in failed:
+            logger.info("Organization {} migrated from Source {} to Target {} successfully!".format(migration.source_org, fetch_url_from_api(migration.source_api_url), fetch_url_from_api(migration.target_api_url)))
+    if failed:
+        sys.exit(1)